@@ -1,435 +1,1922 @@
-from flask import Flask, request, render_template, Response, send_file
+from flask import (Flask, request, render_template, Response, send_file, jsonify, url_for, abort,
+                   stream_with_context)
+from werkzeug.exceptions import ClientDisconnected
 import os
+import csv
+import fcntl
+import hashlib
+import importlib.util
+import json
+import math
+import multiprocessing
+import re
+import signal
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import closing, contextmanager
 import pdfplumber
+from pdfminer.pdfpage import PDFPage
+from pdfplumber.page import Page as PlumberPage
+from pdfplumber.utils import cluster_objects
 import fitz  # PyMuPDF
+import numpy as np
 import pandas as pd
 import io
 import shutil
+from PIL import Image as PILImage
 from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-from reportlab.platypus import Table, TableStyle, Image
+from reportlab.lib.enums import TA_CENTER
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.platypus import HRFlowable, Image, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
 from reportlab.lib import colors
+from reportlab import rl_config
+from reportlab.pdfbase import pdfmetrics
+from xml.sax.saxutils import escape
 import zipfile
 
 
-
-
 app = Flask(__name__)
 
 # Folders for uploads and static files
 UPLOAD_FOLDER = os.path.join("static", "extracted_pdfs")
-STATIC_FOLDER = os.path.join('static', 'images')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(STATIC_FOLDER, exist_ok=True)
 
-app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['STATIC_FOLDER'] = STATIC_FOLDER
+# Conversion job queue (SQLite, shared by all gunicorn workers on the dyno)
+app.config['JOBS_DATABASE'] = os.environ.get("JOBS_DATABASE", "jobs.sqlite3")
+# Web worker processes on the dyno (gunicorn's WEB_CONCURRENCY, see gunicorn.conf.py)
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", 4))
+# Concurrent conversions per web worker, by default the worker's share of the CPU cores;
+# "process" runs them in a process pool, "thread" inline. 0 makes a web-only worker: it
+# starts no conversion threads, so its queued jobs wait for a worker that has them, and
+# converts /convert uploads in a pool of one process
+app.config['CONVERSION_WORKERS'] = int(os.environ.get(
+    "CONVERSION_WORKERS", max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)))
+app.config['CONVERSION_EXECUTOR'] = os.environ.get("CONVERSION_EXECUTOR", "process")
+app.config['CONVERSION_TIMEOUT'] = float(os.environ.get("CONVERSION_TIMEOUT", 120))
+app.config['QUEUE_POLL_INTERVAL'] = float(os.environ.get("QUEUE_POLL_INTERVAL", 0.5))
+# Every web worker heartbeats its running jobs each JOB_HEARTBEAT_INTERVAL seconds. A job whose
+# worker went away (killed, timed out or recycled) is requeued once its heartbeat is JOB_STALE_AFTER
+# seconds old, and failed after JOB_MAX_ATTEMPTS attempts; finished jobs are deleted after JOB_RETENTION
+app.config['JOB_HEARTBEAT_INTERVAL'] = float(os.environ.get("JOB_HEARTBEAT_INTERVAL", 10))
+app.config['JOB_STALE_AFTER'] = float(os.environ.get("JOB_STALE_AFTER", 60))
+app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+app.config['JOB_RETENTION'] = float(os.environ.get("JOB_RETENTION", 7 * 24 * 3600))
+# Seconds between keep-alive comments on an idle progress stream (see /batches/<id>/events), well
+# inside the idle timeouts of routers and proxies
+app.config['EVENTS_KEEPALIVE'] = float(os.environ.get("EVENTS_KEEPALIVE", 15))
+# Resumable chunked uploads (see /uploads): largest chunk accepted per request, and how long an
+# unfinished upload is kept after its last chunk
+app.config['UPLOAD_CHUNK_MAX_BYTES'] = int(os.environ.get("UPLOAD_CHUNK_MAX_BYTES", 8 * 1024 * 1024))
+app.config['UPLOAD_SESSION_TTL'] = float(os.environ.get("UPLOAD_SESSION_TTL", 24 * 3600))
+# Admission control, checked before an upload is parsed (0 turns a limit off). One request may
+# carry at most MAX_REQUEST_FILES reports, MAX_REQUEST_BYTES and MAX_REQUEST_PAGES (413 otherwise);
+# a request that would take the queued and running jobs past MAX_INFLIGHT_JOBS, _BYTES or _PAGES
+# is turned away with 429 and a Retry-After estimate
+app.config['MAX_REQUEST_FILES'] = int(os.environ.get("MAX_REQUEST_FILES", 50))
+app.config['MAX_REQUEST_BYTES'] = int(os.environ.get("MAX_REQUEST_BYTES", 200 * 1024 * 1024))
+app.config['MAX_REQUEST_PAGES'] = int(os.environ.get("MAX_REQUEST_PAGES", 1000))
+app.config['MAX_INFLIGHT_JOBS'] = int(os.environ.get("MAX_INFLIGHT_JOBS", 200))
+app.config['MAX_INFLIGHT_BYTES'] = int(os.environ.get("MAX_INFLIGHT_BYTES", 1024 * 1024 * 1024))
+app.config['MAX_INFLIGHT_PAGES'] = int(os.environ.get("MAX_INFLIGHT_PAGES", 5000))
+# Queued jobs are claimed round robin between clients, told apart by the CLIENT_ID_HEADER header
+# (e.g. a clinic id set by the gateway) or else the remote address; MAX_CLIENT_RUNNING_JOBS caps
+# how many of one client's jobs are converted at once across all workers
+app.config['CLIENT_ID_HEADER'] = os.environ.get("CLIENT_ID_HEADER")
+app.config['MAX_CLIENT_RUNNING_JOBS'] = int(os.environ.get("MAX_CLIENT_RUNNING_JOBS", 0))
+# Content-addressed cache of generated reports, evicted least recently used first
+app.config['RESULT_CACHE_FOLDER'] = os.path.join(UPLOAD_FOLDER, "cache")
+app.config['RESULT_CACHE_MAX_BYTES'] = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+os.makedirs(app.config['RESULT_CACHE_FOLDER'], exist_ok=True)
+
+# Resolution and JPEG quality images are re-encoded at for the boxes they are drawn in
+app.config['REPORT_IMAGE_DPI'] = int(os.environ.get("REPORT_IMAGE_DPI", 150))
+app.config['REPORT_IMAGE_QUALITY'] = int(os.environ.get("REPORT_IMAGE_QUALITY", 80))
+# Prepared images by stream hash: a per-process LRU of at most IMAGE_CACHE_MEMORY_BYTES in front
+# of a folder shared by every worker, evicted least recently used first like the result cache
+app.config['IMAGE_CACHE_FOLDER'] = os.path.join(UPLOAD_FOLDER, "image_cache")
+app.config['IMAGE_CACHE_MAX_BYTES'] = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+app.config['IMAGE_CACHE_MEMORY_BYTES'] = int(os.environ.get("IMAGE_CACHE_MEMORY_BYTES", 16 * 1024 * 1024))
+os.makedirs(app.config['IMAGE_CACHE_FOLDER'], exist_ok=True)
+
+# OCR fallback for pages without a text layer (scanned reports), with pytesseract and the
+# tesseract binary installed: pages are rendered at OCR_DPI and read OCR_WORKERS at a time by each
+# conversion, by default as many as leave every conversion slot on the dyno one core's worth
+app.config['OCR_ENABLED'] = os.environ.get("OCR_ENABLED", "1") != "0"
+app.config['OCR_DPI'] = int(os.environ.get("OCR_DPI", 300))
+app.config['OCR_LANGUAGE'] = os.environ.get("OCR_LANGUAGE", "eng")
+app.config['OCR_WORKERS'] = int(os.environ.get(
+    "OCR_WORKERS", max(1, (os.cpu_count() or 1) // (WEB_CONCURRENCY * max(1, app.config['CONVERSION_WORKERS'])))))
+# Words read by OCR by page content hash, cached like the prepared images
+app.config['OCR_CACHE_FOLDER'] = os.path.join(UPLOAD_FOLDER, "ocr_cache")
+app.config['OCR_CACHE_MAX_BYTES'] = int(os.environ.get("OCR_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+app.config['OCR_CACHE_MEMORY_BYTES'] = int(os.environ.get("OCR_CACHE_MEMORY_BYTES", 4 * 1024 * 1024))
+os.makedirs(app.config['OCR_CACHE_FOLDER'], exist_ok=True)
+
+# Text/table extraction backend used when a request does not pick one (see EXTRACTION_ENGINES)
+app.config['EXTRACTION_ENGINE'] = os.environ.get("EXTRACTION_ENGINE", "pdfplumber")
+
+# Declarative extraction templates, one JSON (or YAML, with PyYAML installed) file per report layout
+app.config['EXTRACTION_TEMPLATE_FOLDER'] = os.environ.get(
+    "EXTRACTION_TEMPLATE_FOLDER", os.path.join(app.root_path, "extraction_templates"))
+# Template used when no other template's fingerprint matches the report
+app.config['DEFAULT_EXTRACTION_TEMPLATE'] = os.environ.get("DEFAULT_EXTRACTION_TEMPLATE", "default")
+
+# Bump whenever the extractors or the output layout change so stale cached reports are not served
+EXTRACTOR_VERSION = "5"
+
+
+class ContentCache:
+    """
+    Bytes by content-derived key, for work worth doing once per distinct input (prepared
+    images, OCR results). Lookups go to a least recently used map bounded by the
+    <prefix>_MEMORY_BYTES setting, then to the <prefix>_FOLDER setting's folder, which
+    every worker process shares and which is held to <prefix>_MAX_BYTES. With disk=False
+    only the in-process map is used, for conversions that write nothing (see convert).
+    """
+
+    def __init__(self, prefix, suffix):
+        self.prefix = prefix
+        self.suffix = suffix
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(app.config[f'{self.prefix}_FOLDER'], f"{key}{self.suffix}")
+
+    def _remember(self, key, data):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > app.config[f'{self.prefix}_MEMORY_BYTES'] and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def get(self, key, disk=True):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                return data
+        if not disk:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as cache_file:
+                data = cache_file.read()
+            # A hit refreshes the modification time, which is what eviction orders by
+            now = time.time()
+            os.utime(path, (now, now))
+        except OSError:
+            return None
+        self._remember(key, data)
+        return data
+
+    def put(self, key, data, disk=True):
+        self._remember(key, data)
+        if not disk:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as cache_file:
+                cache_file.write(data)
+            os.replace(tmp_path, path)
+            evict_cache_folder(app.config[f'{self.prefix}_FOLDER'], app.config[f'{self.prefix}_MAX_BYTES'])
+        except OSError as e:
+            # The cache is only an optimisation; the value is still used by the caller
+            print(f"Error caching {key}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+class ParsedDocument:
+    """
+    Opens an uploaded report once and memoizes per-page parsing results.
+    The source is a file path or the raw PDF bytes. Pages are 1-based to match the
+    extract_data_from_page_N naming; the words and tables of a page, or of a bbox
+    region of it, are only computed the first time they are asked for, and the page
+    tree is only walked as far as the last page asked for, however long the document is.
+    With disk=False, prepared images and OCR results are cached in memory only.
+    """
+
+    def __init__(self, source, disk=True):
+        self.source = source
+        self.disk = disk
+        self._pdf = None
+        self._page_walker = None
+        self._loaded_pages = {}
+        self._doctop = 0
+        self._fitz_doc = None
+        self._template = None
+        self._tables = {}
+        self._words = {}
+        self._ocr = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def pdf(self):
+        if self._pdf is None:
+            if isinstance(self.source, bytes):
+                self._pdf = pdfplumber.open(io.BytesIO(self.source))
+            else:
+                self._pdf = pdfplumber.open(self.source)
+        return self._pdf
+
+    @property
+    def fitz_doc(self):
+        if self._fitz_doc is None:
+            if isinstance(self.source, bytes):
+                self._fitz_doc = fitz.open(stream=self.source, filetype="pdf")
+            else:
+                self._fitz_doc = fitz.open(self.source)
+        return self._fitz_doc
+
+    @property
+    def template(self):
+        """The extraction template for this report's layout, picked by fingerprint on first use."""
+        if self._template is None:
+            self._template = select_template(self)
+        return self._template
+
+    def page(self, page_number):
+        """pdfplumber page by number; pages are loaded from the page tree up to this one."""
+        if page_number not in self._loaded_pages:
+            if self._page_walker is None:
+                self._page_walker = enumerate(PDFPage.create_pages(self.pdf.doc), start=1)
+            for number, pdfminer_page in self._page_walker:
+                page = PlumberPage(self.pdf, pdfminer_page, page_number=number, initial_doctop=self._doctop)
+                self._doctop += page.height
+                self._loaded_pages[number] = page
+                if number >= page_number:
+                    break
+        try:
+            return self._loaded_pages[page_number]
+        except KeyError:
+            raise IndexError(f"Page {page_number} is not in the document") from None
+
+    def tables(self, page_number, bbox=None):
+        key = (page_number, bbox)
+        if key not in self._tables:
+            self._tables[key] = self._extract_tables(page_number, bbox)
+        return self._tables[key]
+
+    def words(self, page_number, bbox=None):
+        """
+        The words of the page, or of a bbox region of it, tokenized once, in reading
+        order, with the numeric value, unit and coordinates of every word (see Tokens).
+        A region is laid out on its own, without the rest of the page.
+        """
+        key = (page_number, bbox)
+        if key not in self._words:
+            words = self._extract_words(page_number, bbox)
+            if words:
+                self._words[key] = tokenize(words, page_number)
+            elif bbox is not None:
+                # An empty region, or one of a scanned page: crop the page's words, read by OCR if need be
+                self._words[key] = self.words(page_number).within(bbox)
+            else:
+                # A scanned page has no text layer; read it with OCR instead
+                self._words[key] = tokenize(self._ocr_words(page_number), page_number)
+        return self._words[key]
+
+    def fields(self, *names):
+        """Values of the named template fields (see ExtractionTemplate.values)."""
+        return self.template.values(self, names)
+
+    def table_rows(self, name):
+        """Rows of the named template table (see ExtractionTemplate.table)."""
+        return self.template.table(self, name)
+
+    def _region(self, page_number, bbox):
+        page = self.page(page_number)
+        return page.crop(bbox) if bbox else page
+
+    def _extract_tables(self, page_number, bbox=None):
+        return self._region(page_number, bbox).extract_tables()
+
+    def _extract_words(self, page_number, bbox=None):
+        # Lines are clustered exactly as extract_text does, so they hold the same words
+        words = self._region(page_number, bbox).extract_words()
+        return [(line_number, word["text"], word["x0"], word["top"], word["x1"], word["bottom"])
+                for line_number, line in enumerate(cluster_objects(words, "top", 3))
+                for word in sorted(line, key=lambda word: word["x0"])]
+
+    def _ocr_words(self, page_number):
+        """
+        Word tuples read by OCR from a page without a text layer, [] when OCR is not
+        available. The first such page also starts OCR of every other text-less page the
+        templates read, so they are read in parallel while extraction goes on.
+        """
+        if not ocr_available():
+            return []
+        if page_number not in self._ocr:
+            pages = {page_number}
+            for page in TEMPLATE_TEXT_PAGES:
+                if (page not in self._ocr and page <= self.fitz_doc.page_count
+                        and not self.fitz_doc[page - 1].get_text("text").strip()):
+                    pages.add(page)
+            self._ocr.update(start_ocr(self.fitz_doc, pages, self.disk))
+        try:
+            return self._ocr[page_number].result()
+        except (OSError, RuntimeError) as e:
+            print(f"Error reading page {page_number} with OCR: {e}")
+            return []
+
+    def release(self, *page_numbers):
+        """Free the layout objects cached for these pages; their memoized tables and words are kept."""
+        for page_number in page_numbers:
+            if page_number in self._loaded_pages:
+                self._loaded_pages[page_number].close()
+
+    def close(self):
+        self.release(*self._loaded_pages)
+        self._loaded_pages = {}
+        self._page_walker = None
+        if self._pdf is not None:
+            # PDF.close() walks the whole page tree to close every page; the loaded ones are released already
+            self._pdf.flush_cache()
+            if not self._pdf.stream_is_external:
+                self._pdf.stream.close()
+            self._pdf = None
+        if self._fitz_doc is not None:
+            self._fitz_doc.close()
+            self._fitz_doc = None
+
+
+class FitzDocument(ParsedDocument):
+    """
+    Same interface as ParsedDocument, but page words and tables come from PyMuPDF
+    instead of pdfplumber's pure-Python layout analysis. Words are regrouped into
+    lines the way pdfplumber clusters them, so the templates see the same lines.
+    A bbox becomes PyMuPDF's clip rectangle (both measure from the top-left corner).
+    """
+
+    line_tolerance = 3
+
+    def _lines(self, page_number, bbox=None):
+        """(x0, word, top, x1, bottom) of the page's words, grouped into lines sorted left to right."""
+        words = self.fitz_doc[page_number - 1].get_text("words", clip=bbox)
+        lines = []
+        for x0, y0, x1, y1, word, *_ in sorted(words, key=lambda w: (w[1], w[0])):
+            if lines and abs(y0 - lines[-1][0]) <= self.line_tolerance:
+                lines[-1][1].append((x0, word, y0, x1, y1))
+            else:
+                lines.append((y0, [(x0, word, y0, x1, y1)]))
+        return [sorted(line) for _, line in lines]
+
+    def _extract_words(self, page_number, bbox=None):
+        return [(line_number, word, x0, top, x1, bottom)
+                for line_number, line in enumerate(self._lines(page_number, bbox))
+                for x0, word, top, x1, bottom in line]
+
+    def _extract_tables(self, page_number, bbox=None):
+        return [table.extract() for table in self.fitz_doc[page_number - 1].find_tables(clip=bbox)]
+
+
+EXTRACTION_ENGINES = {"pdfplumber": ParsedDocument, "fitz": FitzDocument}
+
+# Words read by OCR by page_content_key
+ocr_cache = ContentCache("OCR_CACHE", ".json")
+_ocr_pool = None
+_ocr_pool_pid = None
+_ocr_pool_lock = threading.Lock()
+
+
+# pytesseract is only imported once a scanned page needs it, not at startup
+PYTESSERACT_INSTALLED = importlib.util.find_spec("pytesseract") is not None
+
+
+def ocr_available():
+    return PYTESSERACT_INSTALLED and app.config['OCR_ENABLED']
+
+
+def get_ocr_pool():
+    """
+    Threads that each drive one tesseract process, so OCR_WORKERS pages are read at
+    once without copying page images between processes. Created after fork, per process.
+    """
+    global _ocr_pool, _ocr_pool_pid
+    with _ocr_pool_lock:
+        if _ocr_pool_pid != os.getpid():
+            _ocr_pool = ThreadPoolExecutor(max_workers=app.config['OCR_WORKERS'], thread_name_prefix="ocr")
+            _ocr_pool_pid = os.getpid()
+        return _ocr_pool
 
-def extract_name_and_dob(pdf_path):
+
+def page_content_key(page):
+    """SHA-256 of what a PyMuPDF page draws (its content stream and images) plus the OCR settings."""
+    digest = hashlib.sha256(page.read_contents())
+    for xref, *_ in page.get_images(full=True):
+        digest.update(page.parent.xref_stream_raw(xref))
+    digest.update(f"{tuple(page.rect)}:{page.rotation}:{app.config['OCR_DPI']}:"
+                  f"{app.config['OCR_LANGUAGE']}".encode())
+    return digest.hexdigest()
+
+
+def read_page_words(image, key, dpi, language, disk=True):
+    """
+    OCR a rendered page and cache the result under key (in memory only without disk). Returns (line, text, x0, top, x1,
+    bottom) word tuples in PDF points, with Tesseract's lines numbered top to bottom and
+    their words left to right, as the text layer's words are.
+    """
+    import pytesseract
+    data = pytesseract.image_to_data(image, lang=language, output_type=pytesseract.Output.DICT)
+    scale = 72 / dpi
+    lines = defaultdict(list)
+    for i, text in enumerate(data["text"]):
+        text = text.strip()
+        if not text:
+            continue
+        x0, top = data["left"][i] * scale, data["top"][i] * scale
+        x1, bottom = x0 + data["width"][i] * scale, top + data["height"][i] * scale
+        lines[data["block_num"][i], data["par_num"][i], data["line_num"][i]].append((x0, text, top, x1, bottom))
+    ordered = sorted(lines.values(), key=lambda line: min(word[2] for word in line))
+    words = [[line_number, text, x0, top, x1, bottom]
+             for line_number, line in enumerate(ordered) for x0, text, top, x1, bottom in sorted(line)]
+    ocr_cache.put(key, json.dumps(words).encode(), disk)
+    return words
+
+
+def start_ocr(fitz_doc, page_numbers, disk=True):
+    """
+    Start reading the pages with OCR: {page number: Future of its word tuples}. Pages
+    read before, here or by another worker, come from ocr_cache; the others are rendered
+    here one at a time while the pool reads the ones already rendered. Without disk,
+    ocr_cache's folder is neither read nor written.
+    """
+    dpi, language = app.config['OCR_DPI'], app.config['OCR_LANGUAGE']
+    futures = {}
+    for page_number in sorted(page_numbers):
+        page = fitz_doc[page_number - 1]
+        key = page_content_key(page)
+        cached = ocr_cache.get(key, disk)
+        if cached is not None:
+            futures[page_number] = Future()
+            futures[page_number].set_result(json.loads(cached))
+            continue
+        pixmap = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+        image = PILImage.frombytes("L", (pixmap.width, pixmap.height), pixmap.samples)
+        futures[page_number] = get_ocr_pool().submit(read_page_words, image, key, dpi, language, disk)
+    return futures
+
+
+def open_document(source, engine=None, disk=True):
+    """
+    Open a report with the named extraction engine, defaulting to EXTRACTION_ENGINE;
+    without disk, its caches stay in memory (see ParsedDocument).
+    """
+    return EXTRACTION_ENGINES[engine or app.config['EXTRACTION_ENGINE']](source, disk)
+
+
+class TemplateError(ValueError):
+    """An extraction template file that cannot be compiled."""
+
+
+def _choice(spec, key, choices, default):
+    value = spec.get(key, default)
+    if value not in choices:
+        raise TemplateError(f"{key} must be one of {', '.join(choices)}, not {value!r}")
+    return value
+
+
+def _compile(pattern):
+    return re.compile(pattern) if pattern is not None else None
+
+
+# A number with an optional unit, e.g. 12, -3.5, .5, 9.8Hz or 12.5%
+NUMBER_PATTERN = re.compile(r"^(?P<number>[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))(?P<unit>Hz|%)?$")
+
+
+class Missing(str):
+    """
+    The value of a field the report did not yield. It reads as the rule's missing text
+    (e.g. "Not Found") wherever values are drawn or serialised, and isinstance() tells it
+    apart from a value that happens to read the same.
+    """
+
+    __slots__ = ()
+
+
+class Tokens:
+    """
+    Tokenized words as parallel NumPy arrays in reading order: the line (or table row)
+    of each word, its text, numeric value (NaN when it is not a number), unit ("Hz",
+    "%" or "") and coordinates (NaN for table cells). Indexing with a boolean mask or
+    positions selects words, so every lookup is an array filter.
+    """
+
+    __slots__ = ("page", "line", "text", "value", "unit", "x0", "top", "x1", "bottom")
+
+    def __init__(self, page, line, text, value, unit, x0, top, x1, bottom):
+        self.page = page
+        self.line = line
+        self.text = text
+        self.value = value
+        self.unit = unit
+        self.x0 = x0
+        self.top = top
+        self.x1 = x1
+        self.bottom = bottom
+
+    def __len__(self):
+        return len(self.text)
+
+    def __getitem__(self, selection):
+        return Tokens(self.page, *(getattr(self, name)[selection] for name in self.__slots__[1:]))
+
+    def within(self, bbox):
+        """The words whose centre lies inside bbox (x0, top, x1, bottom)."""
+        x0, top, x1, bottom = bbox
+        center_x = (self.x0 + self.x1) / 2
+        center_y = (self.top + self.bottom) / 2
+        return self[(center_x >= x0) & (center_x <= x1) & (center_y >= top) & (center_y <= bottom)]
+
+    def first_of_each_line(self):
+        return self[np.sort(np.unique(self.line, return_index=True)[1])]
+
+    def lines(self):
+        """{line: [its words]} in reading order."""
+        lines = defaultdict(list)
+        for line, text in zip(self.line.tolist(), self.text.tolist()):
+            lines[line].append(text)
+        return lines
+
+    def line_texts(self):
+        """{line: its words joined by spaces}, as extract_text renders the line."""
+        return {line: " ".join(words) for line, words in self.lines().items()}
+
+
+def tokenize(words, page=None):
+    """
+    Tokenize (line, text, x0, top, x1, bottom) word tuples, parsing the numeric value
+    and unit of every word in one vectorized pass.
+    """
+    lines, texts, x0, top, x1, bottom = zip(*words) if words else ((),) * 6
+    parsed = pd.Series(texts, dtype=object).str.extract(NUMBER_PATTERN)
+    return Tokens(
+        page,
+        np.array(lines, dtype=int),
+        np.array(texts, dtype=object),
+        pd.to_numeric(parsed["number"]).to_numpy(dtype=float),
+        parsed["unit"].fillna("").to_numpy(dtype=object),
+        *(np.array(edge, dtype=float) for edge in (x0, top, x1, bottom)),
+    )
+
+
+class TemplateRule:
+    """
+    One compiled rule of an extraction template. It reads the words of a page, or the
+    cells of one of its tables, optionally cropped to a bbox (x0, top, x1, bottom in
+    PDF points), keeps the tokens matching its filters and maps token positions to
+    field names. Filters run over the tokenized words of the page or its bbox (see Tokens).
+    """
+
+    __slots__ = ("page", "bbox", "source", "table", "cells", "line", "capture", "token", "numeric",
+                 "units", "group", "convert", "fields", "min_count", "rows", "missing")
+
+    def __init__(self, spec, token_patterns):
+        self.page = int(spec["page"])
+        self.bbox = tuple(float(edge) for edge in spec["bbox"]) if spec.get("bbox") else None
+        self.source = _choice(spec, "source", ("text", "table"), "text")
+        self.table = int(spec.get("table", 0))
+        # raw: table rows as extracted; whole: the non-empty cells; words: the cells split into words
+        self.cells = _choice(spec, "cells", ("raw", "whole", "words"), "whole")
+        self.line = _compile(spec.get("line"))
+        self.capture = _compile(spec.get("capture"))
+        token = spec.get("token")
+        self.token = _compile(token_patterns.get(token, token))
+        # numeric: only numbers whose unit is one of units ("" for none, "Hz", "%")
+        self.numeric = bool(spec.get("numeric", False))
+        self.units = list(spec.get("units", [""]))
+        # flat: every kept token in reading order; rows: the first kept token of each line or row
+        self.group = _choice(spec, "group", ("flat", "rows"), "flat")
+        # float takes the parsed numeric value, strip the text without surrounding whitespace
+        self.convert = _choice(spec, "convert", ("none", "strip", "float"), "none")
+        self.fields = {name: int(index) for name, index in spec.get("fields", {}).items()}
+        self.min_count = int(spec.get("min_count", max(self.fields.values(), default=-1) + 1))
+        self.rows = slice(*spec.get("rows", (None, None)))
+        self.missing = Missing(spec.get("missing", "Not Found"))
+
+    def table_cells(self, doc):
+        """Rows of the rule's table, as selected by cells."""
+        tables = doc.tables(self.page, self.bbox)
+        if len(tables) <= self.table:
+            return []
+        rows = tables[self.table]
+        if self.cells == "raw":
+            return rows
+        if self.cells == "words":
+            return [[word for cell in row if cell for word in cell.split()] for row in rows]
+        return [[cell for cell in row if cell] for row in rows]
+
+    def token_stream(self, doc):
+        """Tokens the rule reads, before its token filters."""
+        if self.source == "table":
+            nan = float("nan")
+            return tokenize([(row_number, cell, nan, nan, nan, nan)
+                             for row_number, row in enumerate(self.table_cells(doc)) for cell in row], self.page)
+
+        words = doc.words(self.page, self.bbox)
+        if self.line is None and self.capture is None:
+            return words
+
+        line_texts = words.line_texts()
+        if self.line is not None:
+            line_texts = {line: text for line, text in line_texts.items() if self.line.search(text)}
+            words = words[np.isin(words.line, list(line_texts))]
+        if self.capture is None:
+            return words
+        # One token per line: the captured text, spanning the whole line
+        captured = []
+        for line, text in line_texts.items():
+            match = self.capture.search(text)
+            if match:
+                on_line = words[words.line == line]
+                captured.append((line, match.group(1), on_line.x0.min(), on_line.top.min(),
+                                 on_line.x1.max(), on_line.bottom.max()))
+        return tokenize(captured, self.page)
+
+    def picked(self, doc):
+        """The tokens that count towards the rule's fields, in position order."""
+        tokens = self.token_stream(doc)
+        if self.token is not None:
+            tokens = tokens[np.array([bool(self.token.search(text)) for text in tokens.text], dtype=bool)]
+        if self.numeric:
+            tokens = tokens[~np.isnan(tokens.value) & np.isin(tokens.unit, self.units)]
+        if self.group == "rows":
+            tokens = tokens.first_of_each_line()
+        return tokens
+
+    def tokens(self, doc):
+        """The picked tokens, converted, or None when fewer than min_count were found."""
+        picked = self.picked(doc)
+        if len(picked) < self.min_count:
+            return None
+        if self.convert == "float":
+            return picked.value.tolist()
+        if self.convert == "strip":
+            return [text.strip() for text in picked.text]
+        return picked.text.tolist()
+
+    def table_rows(self, doc):
+        if self.source == "table":
+            return self.table_cells(doc)[self.rows]
+        return list(self.token_stream(doc).lines().values())[self.rows]
+
+
+class ExtractionTemplate:
+    """
+    A report layout compiled from a template file: the fingerprint patterns that
+    recognize it on one page, and an index from every field, table and image name to
+    the rules that produce it, in the order they are tried.
+    """
+
+    def __init__(self, spec, path=None):
+        self.name = spec["name"]
+        self.path = path
+        fingerprint = spec.get("fingerprint", {})
+        self.fingerprint_page = int(fingerprint.get("page", 1))
+        self.fingerprint_bbox = tuple(fingerprint["bbox"]) if fingerprint.get("bbox") else None
+        self.fingerprint = [re.compile(pattern) for pattern in fingerprint.get("patterns", [])]
+
+        token_patterns = spec.get("tokens", {})
+        self.fields = defaultdict(list)
+        for rule_spec in spec.get("fields", []):
+            rule = TemplateRule(rule_spec, token_patterns)
+            for name in rule.fields:
+                self.fields[name].append(rule)
+        self.tables = {
+            name: [TemplateRule(rule_spec, token_patterns) for rule_spec in rule_specs]
+            for name, rule_specs in spec.get("tables", {}).items()
+        }
+        self.images = {name: int(page) for name, page in spec.get("images", {}).items()}
+
+    def matches(self, doc):
+        try:
+            words = doc.words(self.fingerprint_page)
+        except (IndexError, ValueError):
+            return False
+        if self.fingerprint_bbox is not None:
+            words = words.within(self.fingerprint_bbox)
+        text = "\n".join(words.line_texts().values())
+        return all(pattern.search(text) for pattern in self.fingerprint)
+
+    def text_pages(self):
+        """Pages whose words or tables the template reads, fingerprint included."""
+        pages = {self.fingerprint_page}
+        for rules in list(self.fields.values()) + list(self.tables.values()):
+            pages.update(rule.page for rule in rules)
+        return pages
+
+    def pages_for(self, names):
+        """Pages read for the named fields, tables and images."""
+        pages = set()
+        for name in names:
+            pages.update(rule.page for rule in self.fields.get(name, []) + self.tables.get(name, []))
+            if name in self.images:
+                pages.add(self.images[name])
+        return pages
+
+    def values(self, doc, names):
+        """Field values by name. Each field takes its first rule that finds enough tokens."""
+        values = {}
+        tokens_by_rule = {}
+        for name in names:
+            rules = self.fields.get(name, [])
+            for rule in rules:
+                if rule not in tokens_by_rule:
+                    tokens_by_rule[rule] = rule.tokens(doc)
+                tokens = tokens_by_rule[rule]
+                if tokens is not None and rule.fields[name] < len(tokens):
+                    values[name] = tokens[rule.fields[name]]
+                    break
+            else:
+                values[name] = rules[0].missing if rules else Missing("Not Found")
+        return values
+
+    def table(self, doc, name):
+        """Rows of the named table from its first rule that finds any."""
+        for rule in self.tables.get(name, []):
+            rows = rule.table_rows(doc)
+            if rows:
+                return rows
+        return []
+
+
+TEMPLATE_EXTENSIONS = (".json", ".yaml", ".yml")
+
+
+def parse_template(data, path):
+    """The template spec in one file's contents; YAML templates need PyYAML."""
+    if path.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise TemplateError("YAML templates need PyYAML (pip install pyyaml)") from None
+        return yaml.safe_load(data)
+    return json.loads(data)
+
+
+def compile_template(data, path):
+    """Compile the contents of one template file."""
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            first_page = pdf.pages[0]
-            text = first_page.extract_text()
-            name = next((line.split(":")[1] for line in text.split("\n") if "NAME" in line), "Not found")
-            dob = next((line.split(":")[1] for line in text.split("\n") if "D.O.B." in line), "Not found")
-            return {"name": name.strip(), "dob": dob.strip()}
+        return ExtractionTemplate(parse_template(data, path), path)
+    except (KeyError, TypeError, ValueError, re.error) as e:
+        raise TemplateError(f"{path}: {e}") from e
+
+
+def load_templates(folder):
+    """Compile every template in folder. Returns the templates by file name and a digest of the files."""
+    templates = []
+    digest = hashlib.sha256()
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith(TEMPLATE_EXTENSIONS):
+            path = os.path.join(folder, filename)
+            with open(path, "rb") as template_file:
+                data = template_file.read()
+            digest.update(data)
+            templates.append(compile_template(data, path))
+    return templates, digest.hexdigest()
+
+
+# Compiled once per process; TEMPLATES_DIGEST is part of the result cache key
+EXTRACTION_TEMPLATES, TEMPLATES_DIGEST = load_templates(app.config['EXTRACTION_TEMPLATE_FOLDER'])
+# Pages OCR reads ahead once a report turns out to be scanned
+TEMPLATE_TEXT_PAGES = sorted(set().union(*(template.text_pages() for template in EXTRACTION_TEMPLATES)))
+
+
+def select_template(doc):
+    """The first template whose fingerprint matches the report, else DEFAULT_EXTRACTION_TEMPLATE."""
+    default = None
+    for template in EXTRACTION_TEMPLATES:
+        if template.name == app.config['DEFAULT_EXTRACTION_TEMPLATE']:
+            default = template
+        elif template.matches(doc):
+            return template
+    if default is None:
+        raise LookupError(f"No extraction template named {app.config['DEFAULT_EXTRACTION_TEMPLATE']!r}")
+    return default
+
+
+def extractor(*names):
+    """Declare the template fields, tables or images an extractor reads, so their pages are released after it."""
+    def register(func):
+        func.names = names
+        return func
+    return register
+
+
+def parse_number(value):
+    """(number, unit) of an extracted value such as 12.5, "9.8Hz" or "24%"; (None, None) when it is not one."""
+    if isinstance(value, float):
+        return value, None
+    match = NUMBER_PATTERN.match(value.strip()) if isinstance(value, str) and not isinstance(value, Missing) else None
+    if match is None:
+        return None, None
+    return float(match["number"]), match["unit"]
+
+
+class Metric:
+    """
+    One extracted metric: the value as the report gives it (a float, text such as "9.8Hz",
+    or Missing) and the number and unit read from it. Iterates as its (name, value) table row.
+    """
+
+    __slots__ = ("name", "value", "number", "unit")
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+        self.number, self.unit = parse_number(value)
+
+    def __iter__(self):
+        yield self.name
+        yield self.value
+
+    def __repr__(self):
+        return f"Metric({self.name!r}, {self.value!r})"
+
+
+class ReportMetrics:
+    """
+    The patient's name and DOB and every metric of one report, in report order.
+    as_dict() is the JSON form kept with cached results; to_frame() builds a DataFrame
+    for bulk analytics, only when asked for.
+    """
+
+    __slots__ = ("name", "dob", "metrics")
+
+    def __init__(self, name, dob, metrics):
+        self.name = name
+        self.dob = dob
+        self.metrics = {metric.name: metric for metric in metrics}
+
+    def __iter__(self):
+        return iter(self.metrics.values())
+
+    def get(self, name):
+        """The named Metric, or None when the report has no such metric."""
+        return self.metrics.get(name)
+
+    def as_dict(self):
+        metrics = {"Name": self.name, "DOB": self.dob}
+        metrics.update((metric.name, metric.value) for metric in self)
+        return metrics
+
+    def to_frame(self):
+        """One row per metric: its name, value, number and unit."""
+        return pd.DataFrame([(metric.name, metric.value, metric.number, metric.unit) for metric in self],
+                            columns=["Metric", "Value", "Number", "Unit"])
+
+
+def metric_table(doc, metrics):
+    """Metrics of template fields, in the given order."""
+    values = doc.fields(*metrics)
+    return [Metric(metric, values[metric]) for metric in metrics]
+
+
+@extractor("name", "dob")
+def extract_name_and_dob(doc):
+    try:
+        return doc.fields("name", "dob")
     except Exception as e:
         print(f"Error processing PDF: {e}")
         return {"name": "Error", "dob": "Invalid PDF"}
 
 
-def extract_images(pdf_path):
-    """Extract the first image from specific pages in the PDF."""
-    doc = fitz.open(pdf_path)
+# Images drawn in the report and the box (width, height in points) each is drawn in;
+# the template says which page each comes from
+REPORT_IMAGES = {"imagefrompage5": (300, 150), "imagefrompage6": (300, 150), "imagefrompage9": (200, 150)}
+
+# An embedded image prepared for the report: encoded bytes and the box it is drawn in
+ReportImage = namedtuple("ReportImage", "data width height")
+
+
+# Prepared report images by image_cache_key
+image_cache = ContentCache("IMAGE_CACHE", ".img")
+
+
+def image_cache_key(stream, box):
+    """SHA-256 of an image's raw PDF stream plus the box it is drawn in and the image settings."""
+    digest = hashlib.sha256(stream)
+    digest.update(f"{EXTRACTOR_VERSION}:{box}:{app.config['REPORT_IMAGE_DPI']}:"
+                  f"{app.config['REPORT_IMAGE_QUALITY']}".encode())
+    return digest.hexdigest()
+
+
+def decode_image(fitz_doc, xref):
+    """
+    Decode an embedded image into a Pillow image. Returns (image, original) where original
+    is the stream itself when it is already a JPEG file ReportLab could embed as is.
+    Other images are decoded straight from the PDF into pixels, without the PNG round
+    trip of fitz's extract_image.
+    """
+    if "DCTDecode" in fitz_doc.xref_get_key(xref, "Filter")[1]:
+        original = fitz_doc.xref_stream_raw(xref)
+        return PILImage.open(io.BytesIO(original)), original
+    pixmap = fitz.Pixmap(fitz_doc, xref)
+    if pixmap.colorspace is None or pixmap.colorspace.n not in (1, 3):
+        pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+    mode = ("L" if pixmap.colorspace.n == 1 else "RGB") + ("A" if pixmap.alpha else "")
+    return PILImage.frombytes(mode, (pixmap.width, pixmap.height), pixmap.samples), None
+
+
+def prepare_image(image, box, original=None):
+    """
+    Get a decoded image ready for the box it is drawn in.
+    Continuous-tone images (photos, heat maps) are downscaled to REPORT_IMAGE_DPI and
+    re-encoded as JPEG at REPORT_IMAGE_QUALITY, which ReportLab embeds as is. Line art
+    (at most 256 colours) keeps its pixels: resampling would blur it into thousands of
+    colours that compress far worse. It is handed over as a quickly compressed PNG,
+    since ReportLab decodes and deflates it again anyway. An original JPEG that needs
+    no downscaling and is already smaller is kept.
+    """
+    dpi = app.config['REPORT_IMAGE_DPI']
+    target = (max(1, round(box[0] * dpi / 72)), max(1, round(box[1] * dpi / 72)))
+    # JPEGs can be decoded straight at a reduced scale that still covers the target
+    image.draft("RGB", target)
+    if image.getcolors(256) is not None:
+        if original is not None:
+            return ReportImage(original, *box)
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG", compress_level=1)
+        return ReportImage(buffer.getvalue(), *box)
+
+    size = (min(image.width, target[0]), min(image.height, target[1]))
+    if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+        rgba = image.convert("RGBA")
+        rgb = PILImage.new("RGB", image.size, "white")
+        rgb.paste(rgba, mask=rgba.getchannel("A"))
+    else:
+        rgb = image.convert("RGB")
+    resized = size != image.size
+    if resized:
+        rgb = rgb.resize(size, PILImage.LANCZOS, reducing_gap=3.0)
+
+    buffer = io.BytesIO()
+    rgb.save(buffer, "JPEG", quality=app.config['REPORT_IMAGE_QUALITY'], optimize=True)
+    if not resized and original is not None and len(original) <= buffer.tell():
+        return ReportImage(original, *box)
+    return ReportImage(buffer.getvalue(), *box)
+
+
+@extractor(*REPORT_IMAGES)
+def extract_images(doc):
+    """
+    Extract the first image from specific pages in the PDF.
+    The images are returned as ReportImages sized for their box (see prepare_image);
+    they are held in memory and belong to this conversion only, so concurrent
+    conversions never share files. Identical images, whether the same xref, duplicated
+    streams or an image seen in an earlier report, are recognised by the hash of their
+    stream and served from image_cache instead of being decoded again.
+    """
+    fitz_doc = doc.fitz_doc
     images = {}
-    
-    # Define the mapping of pages to variables
-    page_image_map = {5: "imagefrompage5", 6: "imagefrompage6", 9: "imagefrompage9"}
 
     try:
-        for page_num, var_name in page_image_map.items():
+        for var_name, box in REPORT_IMAGES.items():
+            page_num = doc.template.images.get(var_name)
+            if page_num is None:
+                continue
             # Get the page (0-based indexing in PyMuPDF)
-            page = doc[page_num - 1]
+            page = fitz_doc[page_num - 1]
             page_images = page.get_images(full=True)
 
             # Extract the first image from the page
             if page_images:
-                img = page_images[0]
-                xref = img[0]
-                base_image = doc.extract_image(xref)
-                image_bytes = base_image["image"]
-                image_ext = base_image["ext"]
-
-                # Save the image to the static folder
-                image_path = os.path.join(STATIC_FOLDER, f"{var_name}.{image_ext}")
-                with open(image_path, "wb") as img_file:
-                    img_file.write(image_bytes)
-
-                # Add the image path to the dictionary for rendering
-                images[var_name] = f"/static/images/{os.path.basename(image_path)}"
+                xref = page_images[0][0]
+                key = image_cache_key(fitz_doc.xref_stream_raw(xref), box)
+                data = image_cache.get(key, doc.disk)
+                if data is None:
+                    try:
+                        image, original = decode_image(fitz_doc, xref)
+                        with image:
+                            data = prepare_image(image, box, original).data
+                    except (OSError, ValueError, RuntimeError) as e:
+                        # Cannot decode it here; ReportLab may still be able to embed it as is
+                        print(f"Error preparing image from page {page_num}: {e}")
+                        data = fitz_doc.extract_image(xref)["image"]
+                    image_cache.put(key, data, doc.disk)
+                images[var_name] = ReportImage(data, *box)
             else:
                 print(f"No images found on page {page_num}.")
     except Exception as e:
         print(f"Error extracting images: {e}")
-    finally:
-        doc.close()
 
     return images
 
 
-def extract_data_from_page_4(pdf_path):
-    with pdfplumber.open(pdf_path) as pdf:
-        fourth_page = pdf.pages[3]
-        fourth_page_text = fourth_page.extract_text()
+PAGE_4_METRICS = ("Standard Frequency", "Dominant Frequency")
 
-    standard_frequency = "Not Found"
-    dominant_frequency = "Not Found"
 
-    if fourth_page_text:
-        lines = fourth_page_text.split('\n')
-        frequencies = [word for line in lines for word in line.split() if "Hz" in word]
-        if len(frequencies) >= 2:
-            standard_frequency = frequencies[1]
-            dominant_frequency = frequencies[0]
-
-    return pd.DataFrame(
-        [{"Metric": "Standard Frequency", "Value": standard_frequency},
-         {"Metric": "Dominant Frequency", "Value": dominant_frequency}]
-    )
+@extractor(*PAGE_4_METRICS)
+def extract_data_from_page_4(doc):
+    return metric_table(doc, PAGE_4_METRICS)
 
 
-def extract_data_from_page_5(pdf_path):
-    with pdfplumber.open(pdf_path) as pdf:
-        fifth_page = pdf.pages[4]
-        raw_text = fifth_page.extract_text()
-        tables = fifth_page.extract_tables()
-
-    parsed_data = []
-    if raw_text:
-        lines = raw_text.split('\n')
-        for line in lines:
-            if any(char.isdigit() or '%' in char for char in line):
-                parsed_data.append(line.split())
-
-    table_1 = pd.DataFrame(parsed_data[:2]) if parsed_data else pd.DataFrame(tables[0]) if tables else pd.DataFrame()
-    table_2 = pd.DataFrame(parsed_data[2:]) if len(parsed_data) > 2 else pd.DataFrame(tables[1]) if len(tables) > 1 else pd.DataFrame()
-    max_columns = max(table_1.shape[1], table_2.shape[1])
-    table_1 = table_1.reindex(columns=range(max_columns), fill_value=None)
-    table_2 = table_2.reindex(columns=range(max_columns), fill_value=None)
-    column_names = [f"Column {i+1}" for i in range(max_columns)]
-    table_1.columns = column_names
-    table_2.columns = column_names
-    table_1 = table_1.loc[:, ~table_1.columns.isin(["Column 6"])]
+@extractor("page_5_table_1", "page_5_table_2")
+def extract_data_from_page_5(doc):
+    table_1 = doc.table_rows("page_5_table_1")
+    table_2 = doc.table_rows("page_5_table_2")
+    # Both tables are padded with empty cells to the widest row of either
+    max_columns = max((len(row) for row in table_1 + table_2), default=0)
+    table_1 = [list(row) + [None] * (max_columns - len(row)) for row in table_1]
+    table_2 = [list(row) + [None] * (max_columns - len(row)) for row in table_2]
+    # Column 6 of the first table is not part of the report
+    table_1 = [row[:5] + row[6:] for row in table_1]
 
     return table_1, table_2
 
 
-def extract_data_from_page_6(pdf_path):
-    p_tension_left = "Not Found"
-    p_tension_right = "Not Found"
+PAGE_6_METRICS = ("P. Tension Left", "P. Tension Right")
+
+
+@extractor(*PAGE_6_METRICS)
+def extract_data_from_page_6(doc):
+    return metric_table(doc, PAGE_6_METRICS)
+
+
+PAGE_7_DISTRACTION_METRICS = ("Distraction Left", "Distraction Right")
+PAGE_7_A_MINUS_B_METRICS = ("A/-B Left", "A/-B Right")
+
+
+@extractor(*PAGE_7_DISTRACTION_METRICS, *PAGE_7_A_MINUS_B_METRICS)
+def extract_data_from_page_7(doc):
+    return metric_table(doc, PAGE_7_DISTRACTION_METRICS), metric_table(doc, PAGE_7_A_MINUS_B_METRICS)
+
+
+PAGE_8_RATIO_METRICS = ("Avg. A (Left)", "Avg. A (Right)", "+B (Left)", "+B (Right)",
+                        "Diff. Ratio La - Ra", "Diff. Ratio +B (CE)")
+PAGE_8_SYMMETRY_METRICS = ("Amp. Symmetry", "L-R Sympathy")
+
+
+@extractor(*PAGE_8_RATIO_METRICS, *PAGE_8_SYMMETRY_METRICS)
+def extract_data_from_page_8(doc):
+    return metric_table(doc, PAGE_8_RATIO_METRICS), metric_table(doc, PAGE_8_SYMMETRY_METRICS)
+
+
+PAGE_9_METRICS = ("Sum", "Average", "Max Dev", "Std Dev")
+
+
+@extractor(*PAGE_9_METRICS)
+def extract_data_from_page_9(doc):
+    return metric_table(doc, PAGE_9_METRICS)
+
+
+def get_jobs_db():
+    """Open a connection to the job queue database, creating the schema on first use."""
+    connection = sqlite3.connect(app.config['JOBS_DATABASE'], timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            batch_id TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            input_path TEXT NOT NULL,
+            output_path TEXT NOT NULL,
+            cache_key TEXT NOT NULL,
+            engine TEXT NOT NULL,
+            client TEXT NOT NULL DEFAULT '',
+            size INTEGER NOT NULL DEFAULT 0,
+            pages INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'queued',
+            stage TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            owner TEXT,
+            heartbeat REAL,
+            error TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        )
+    """)
+    connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+    connection.execute("CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_at)")
+    # When each client last had a job started, for taking clients in turn
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS clients (
+            client TEXT PRIMARY KEY,
+            last_started REAL NOT NULL
+        )
+    """)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS uploads (
+            id TEXT PRIMARY KEY,
+            batch_id TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            engine TEXT NOT NULL,
+            client TEXT NOT NULL DEFAULT '',
+            size INTEGER NOT NULL,
+            sha256 TEXT,
+            received INTEGER NOT NULL DEFAULT 0,
+            job_id TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    # Metric values served on /metrics, shared by every web worker: labels is the
+    # series' Prometheus label set, e.g. 'stage="parse",le="0.5"'
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL DEFAULT '',
+            value NUMERIC NOT NULL DEFAULT 0,
+            PRIMARY KEY (name, labels)
+        )
+    """)
+    return connection
+
+
+def enqueue_job(batch_id, filename, input_path, output_path, cache_key, engine, status="queued",
+                client="", size=0, pages=0, job_id=None):
+    """
+    Record a job and return its id. A job recorded as "running" is one this process runs
+    itself (see convert) rather than one a conversion worker claims.
+    """
+    job_id = job_id or uuid.uuid4().hex
+    now = time.time()
+    running = status == "running"
+    with closing(get_jobs_db()) as db:
+        db.execute(
+            "INSERT INTO jobs (id, batch_id, filename, input_path, output_path, cache_key, engine, client,"
+            " size, pages, status, owner, heartbeat, created_at, started_at, finished_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, batch_id, filename, input_path, output_path, cache_key, engine, client, size, pages, status,
+             worker_id() if running else None, now if running else None, now, now if running else None,
+             now if status == "done" else None),
+        )
+    return job_id
 
-    with pdfplumber.open(pdf_path) as pdf:
-        sixth_page = pdf.pages[5]
-        page_text = sixth_page.extract_text()
 
-        if page_text:
-            lines = page_text.split('\n')
-            numeric_rows = []
-            for line in lines:
-                try:
-                    numeric_values = [float(value) for value in line.split() if value.replace('.', '', 1).isdigit()]
-                    if numeric_values:
-                        numeric_rows.append(numeric_values)
-                except ValueError:
+def get_job(job_id):
+    with closing(get_jobs_db()) as db:
+        return db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+
+def get_batch_jobs(batch_id):
+    with closing(get_jobs_db()) as db:
+        return db.execute("SELECT * FROM jobs WHERE batch_id = ? ORDER BY created_at", (batch_id,)).fetchall()
+
+
+def worker_id():
+    """Identifies this web worker process as the owner of the jobs it runs."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_next_job():
+    """
+    Atomically move the next queued job to 'running', owned by this process, and return
+    it, or None if no job can start. Clients take turns: the next job is the oldest one of
+    the client with the fewest running jobs, and of those the client whose last job started
+    longest ago, so one large batch cannot hold back everyone else's. Clients at
+    MAX_CLIENT_RUNNING_JOBS wait.
+    """
+    with closing(get_jobs_db()) as db:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            job = db.execute(
+                "SELECT jobs.* FROM jobs LEFT JOIN clients USING (client) LEFT JOIN ("
+                "  SELECT client, COUNT(*) AS running FROM jobs WHERE status = 'running' GROUP BY client"
+                ") AS busy USING (client)"
+                " WHERE jobs.status = 'queued' AND (? = 0 OR COALESCE(busy.running, 0) < ?)"
+                " ORDER BY COALESCE(busy.running, 0), COALESCE(clients.last_started, 0), jobs.created_at LIMIT 1",
+                (app.config['MAX_CLIENT_RUNNING_JOBS'], app.config['MAX_CLIENT_RUNNING_JOBS']),
+            ).fetchone()
+            if job is not None:
+                now = time.time()
+                db.execute(
+                    "UPDATE jobs SET status = 'running', started_at = ?, owner = ?, heartbeat = ? WHERE id = ?",
+                    (now, worker_id(), now, job["id"]),
+                )
+                db.execute(
+                    "INSERT INTO clients (client, last_started) VALUES (?, ?)"
+                    " ON CONFLICT (client) DO UPDATE SET last_started = excluded.last_started",
+                    (job["client"], now),
+                )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+    return job
+
+
+def enqueue_upload(batch_id, filename, stream, engine, save, client="", pages=0, job_id=None, cache_key=None):
+    """
+    Queue the conversion of one uploaded report and return the job id; an upload that is
+    already in the result cache is recorded as done straight away. save(path) stores the
+    upload where the conversion worker reads it. The job is queued for client and counts
+    the upload's size and pages against the in-flight limits until it finishes.
+    cache_key is the upload's upload_cache_key, when the caller has already computed it.
+    """
+    cache_key = cache_key or upload_cache_key(stream, engine)
+    output_path, _ = cached_result_paths(cache_key)
+    if lookup_cached_result(cache_key):
+        return enqueue_job(batch_id, filename, "", output_path, cache_key, engine, status="done", client=client,
+                           job_id=job_id)
+
+    # Save uploaded file under a unique name so concurrent uploads never collide
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex}.pdf")
+    size = stream_size(stream)
+    save(file_path)
+    return enqueue_job(batch_id, filename, file_path, output_path, cache_key, engine, client=client, size=size,
+                       pages=pages, job_id=job_id)
+
+
+def record_job_stage(job_id, stage):
+    """Note the last conversion stage (see CONVERSION_STAGES) a running job has completed."""
+    with closing(get_jobs_db()) as db:
+        db.execute("UPDATE jobs SET stage = ? WHERE id = ?", (stage, job_id))
+
+
+def job_progress(job_id):
+    """The progress callback for generate_extracted_pdf: records each stage on the job, if there is one."""
+    if job_id is None:
+        return untracked
+    return lambda stage: record_job_stage(job_id, stage)
+
+
+def requeue_job(job_id):
+    """Put a job that was interrupted through no fault of its own back in the queue, counting the attempt."""
+    with closing(get_jobs_db()) as db:
+        db.execute(
+            "UPDATE jobs SET status = 'queued', stage = NULL, started_at = NULL, owner = NULL, heartbeat = NULL,"
+            " attempts = attempts + 1 WHERE id = ? AND status = 'running'",
+            (job_id,),
+        )
+
+
+def finish_job(job_id, error=None):
+    # Only a running job: one given up on by recover_stale_jobs keeps that outcome
+    with closing(get_jobs_db()) as db:
+        db.execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ? AND status = 'running'",
+            ("failed" if error else "done", error, time.time(), job_id),
+        )
+
+
+def recover_stale_jobs():
+    """
+    Requeue the running jobs whose worker stopped heartbeating them, or fail those that
+    have had JOB_MAX_ATTEMPTS attempts or have no upload on disk to convert again (those
+    of /convert, which converts in memory). A job running
+    well past CONVERSION_TIMEOUT in a live worker (the "thread" executor has no timeout)
+    is failed as timed out. Returns the ids of the jobs it failed.
+    """
+    now = time.time()
+    stale_before = now - app.config['JOB_STALE_AFTER']
+    started_before = now - app.config['CONVERSION_TIMEOUT'] - CONVERSION_TIMEOUT_GRACE - app.config['JOB_STALE_AFTER']
+    failed = []
+    with closing(get_jobs_db()) as db:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            stale = db.execute(
+                "SELECT id, input_path, attempts, heartbeat < ? AS abandoned FROM jobs"
+                " WHERE status = 'running' AND (heartbeat < ? OR started_at < ?)",
+                (stale_before, stale_before, started_before),
+            ).fetchall()
+            for job in stale:
+                if job["abandoned"] and job["input_path"] and job["attempts"] + 1 < app.config['JOB_MAX_ATTEMPTS']:
+                    db.execute(
+                        "UPDATE jobs SET status = 'queued', stage = NULL, started_at = NULL, owner = NULL,"
+                        " heartbeat = NULL, attempts = attempts + 1 WHERE id = ?",
+                        (job["id"],),
+                    )
                     continue
+                error = "Conversion was interrupted" if job["abandoned"] else "Conversion timed out"
+                db.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                    (error, now, job["id"]),
+                )
+                failed.append(job)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+    for job in failed:
+        if job["abandoned"] and os.path.exists(job["input_path"]):
+            os.remove(job["input_path"])
+    return [job["id"] for job in failed]
+
+
+def prune_jobs():
+    """Delete jobs that finished more than JOB_RETENTION seconds ago, and clients idle as long."""
+    cutoff = time.time() - app.config['JOB_RETENTION']
+    with closing(get_jobs_db()) as db:
+        db.execute("DELETE FROM jobs WHERE finished_at < ?", (cutoff,))
+        db.execute("DELETE FROM clients WHERE last_started < ?", (cutoff,))
+
+
+def maintain_queue():
+    """Runs in every web worker: heartbeat the jobs it runs, recover stale ones and prune old ones."""
+    while True:
+        try:
+            with closing(get_jobs_db()) as db:
+                db.execute("UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status = 'running'",
+                           (time.time(), worker_id()))
+            recover_stale_jobs()
+            prune_jobs()
+        except sqlite3.Error as e:
+            print(f"Error maintaining the job queue: {e!r}")
+        time.sleep(app.config['JOB_HEARTBEAT_INTERVAL'])
+
+
+def job_to_dict(job):
+    data = {
+        'id': job["id"],
+        'batch_id': job["batch_id"],
+        'filename': job["filename"],
+        'status': job["status"],
+        'status_url': url_for('job_status', job_id=job["id"]),
+    }
+    if job["stage"]:
+        data['stage'] = job["stage"]
+    if job["status"] == "done":
+        data['pdf_path'] = url_for('job_result', job_id=job["id"])
+        cached = lookup_cached_result(job["cache_key"], count=False)
+        if cached:
+            data['metrics'] = cached[1]
+    if job["error"]:
+        data['error'] = job["error"]
+    return data
+
+
+def get_upload(upload_id):
+    with closing(get_jobs_db()) as db:
+        return db.execute("SELECT * FROM uploads WHERE id = ?", (upload_id,)).fetchone()
+
+
+def upload_part_path(upload_id):
+    return os.path.join(app.config['UPLOAD_FOLDER'], f"{upload_id}.part")
+
+
+def upload_to_dict(upload):
+    data = {
+        'id': upload["id"],
+        'batch_id': upload["batch_id"],
+        'filename': upload["filename"],
+        'size': upload["size"],
+        'offset': upload["received"],
+        'upload_url': url_for('upload_chunk', upload_id=upload["id"]),
+    }
+    if upload["job_id"]:
+        job = get_job(upload["job_id"])
+        if job is not None:
+            data['job'] = job_to_dict(job)
+    return data
+
+
+def batch_exists(batch_id):
+    with closing(get_jobs_db()) as db:
+        return db.execute(
+            "SELECT 1 FROM uploads WHERE batch_id = ? UNION ALL SELECT 1 FROM jobs WHERE batch_id = ? LIMIT 1",
+            (batch_id, batch_id),
+        ).fetchone() is not None
+
+
+def expire_upload_sessions():
+    """Forget uploads that saw no chunk for UPLOAD_SESSION_TTL seconds, with the data of unfinished ones."""
+    cutoff = time.time() - app.config['UPLOAD_SESSION_TTL']
+    with closing(get_jobs_db()) as db:
+        expired = db.execute("SELECT id, job_id FROM uploads WHERE updated_at < ?", (cutoff,)).fetchall()
+        for upload in expired:
+            if upload["job_id"] is None and os.path.exists(upload_part_path(upload["id"])):
+                os.remove(upload_part_path(upload["id"]))
+            db.execute("DELETE FROM uploads WHERE id = ?", (upload["id"],))
+
+
+def rewind_upload(upload_id):
+    """Drop the data of an upload and release its claim, for the client to send it again from offset 0."""
+    open(upload_part_path(upload_id), "wb").close()
+    with closing(get_jobs_db()) as db:
+        db.execute("UPDATE uploads SET received = 0, job_id = NULL WHERE id = ?", (upload_id,))
+
+
+def complete_upload(upload):
+    """
+    Queue the conversion of a fully received upload. Returns the error response, after
+    rewinding the upload to offset 0, when the file does not match its declared SHA-256
+    or its pages are over the admission limits. Of concurrent requests completing the
+    same upload, only the first queues it.
+    """
+    # Claim the upload by giving it its job id up front, so it is queued exactly once
+    job_id = uuid.uuid4().hex
+    with closing(get_jobs_db()) as db:
+        claimed = db.execute(
+            "UPDATE uploads SET job_id = ? WHERE id = ? AND job_id IS NULL", (job_id, upload["id"])
+        ).rowcount
+    if not claimed:
+        return None
+
+    part_path = upload_part_path(upload["id"])
+    try:
+        with open(part_path, "rb") as part:
+            if upload["sha256"]:
+                digest = hashlib.sha256()
+                for chunk in iter(lambda: part.read(64 * 1024), b""):
+                    digest.update(chunk)
+                if digest.hexdigest() != upload["sha256"].lower():
+                    part.close()
+                    rewind_upload(upload["id"])
+                    return "Uploaded file does not match its SHA-256; upload it again from offset 0", 400
+                part.seek(0)
+            cache_key = upload_cache_key(part, upload["engine"])
+            # Admitted on its declared size when it was created, and on its pages now they are known
+            pages = uncached_pages(part, cache_key)
+            rejected = admission_error(1, 0, pages)
+            if rejected:
+                part.close()
+                rewind_upload(upload["id"])
+                return rejected
+            enqueue_upload(upload["batch_id"], upload["filename"], part, upload["engine"],
+                           lambda path: os.replace(part_path, path), upload["client"], pages, job_id, cache_key)
+    except BaseException:
+        # Release the claim so that the upload can be completed again
+        with closing(get_jobs_db()) as db:
+            db.execute("UPDATE uploads SET job_id = NULL WHERE id = ? AND job_id = ?", (upload["id"], job_id))
+        raise
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    return None
+
+
+def upload_cache_key(stream, engine):
+    """
+    SHA-256 of the uploaded bytes plus EXTRACTOR_VERSION, the extraction templates,
+    the image and OCR settings and the engine; rewinds the stream for saving.
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(64 * 1024), b""):
+        digest.update(chunk)
+    stream.seek(0)
+    image_settings = f"{app.config['REPORT_IMAGE_DPI']}:{app.config['REPORT_IMAGE_QUALITY']}"
+    ocr_settings = f"{app.config['OCR_DPI']}:{app.config['OCR_LANGUAGE']}" if ocr_available() else "no OCR"
+    digest.update(f"{EXTRACTOR_VERSION}:{TEMPLATES_DIGEST}:{image_settings}:{ocr_settings}:{engine}".encode())
+    return digest.hexdigest()
 
-            if len(numeric_rows) >= 2:
-                p_tension_left = numeric_rows[0][0]
-                p_tension_right = numeric_rows[1][0]
 
-    return pd.DataFrame(
-        [{"Metric": "P. Tension Left", "Value": p_tension_left},
-         {"Metric": "P. Tension Right", "Value": p_tension_right}]
-    )
+def cached_result_paths(cache_key):
+    base = os.path.join(app.config['RESULT_CACHE_FOLDER'], cache_key)
+    return f"{base}_extracted.pdf", f"{base}.json"
 
 
-def extract_data_from_page_7(pdf_path):
-    distraction_left = "Not Found"
-    distraction_right = "Not Found"
-    a_minus_b_left = "Not Found"
-    a_minus_b_right = "Not Found"
+def lookup_cached_result(cache_key, count=True):
+    """
+    Return (pdf_path, metrics) for a previously generated report, or None.
+    A hit refreshes the entry's modification time, which is what eviction orders by.
+    """
+    pdf_path, metrics_path = cached_result_paths(cache_key)
+    try:
+        with open(metrics_path) as metrics_file:
+            metrics = json.load(metrics_file)
+        now = time.time()
+        os.utime(pdf_path, (now, now))
+        os.utime(metrics_path, (now, now))
+        result = (pdf_path, metrics)
+    except (OSError, ValueError):
+        result = None
 
-    with pdfplumber.open(pdf_path) as pdf:
-        seventh_page = pdf.pages[6]
-        seventh_page_tables = seventh_page.extract_tables()
+    if count:
+        increment_counters({(f"pdfdata_result_cache_{'hits' if result else 'misses'}_total", ""): 1})
+    return result
 
-        if seventh_page_tables:
-            print("Extracted Tables:", seventh_page_tables)  # Debug: Analyze table structure
 
-            # Process Table 2 for Distraction Values
-            if len(seventh_page_tables) > 1:
-                table_2 = seventh_page_tables[1]
-                try:
-                    distraction_values = [
-                        float(cell) for row in table_2 for cell in row if cell and cell.replace('.', '', 1).isdigit()
-                    ]
-                    if len(distraction_values) >= 2:
-                        distraction_left, distraction_right = distraction_values[:2]
-                except ValueError as e:
-                    print(f"Error parsing distraction values: {e}")
-
-            # Process Table 3 for A/-B Values
-            if len(seventh_page_tables) > 2:
-                table_3 = seventh_page_tables[2]
+def store_cached_result(cache_key, rendered_path, metrics):
+    """Move a freshly rendered report into the cache atomically, then enforce the size limit."""
+    pdf_path, metrics_path = cached_result_paths(cache_key)
+    os.replace(rendered_path, pdf_path)
+    metrics_tmp_path = f"{metrics_path}.{uuid.uuid4().hex}.tmp"
+    with open(metrics_tmp_path, "w") as metrics_file:
+        json.dump(metrics, metrics_file)
+    os.replace(metrics_tmp_path, metrics_path)
+    evict_result_cache()
+
+
+def evict_result_cache():
+    evict_cache_folder(app.config['RESULT_CACHE_FOLDER'], app.config['RESULT_CACHE_MAX_BYTES'])
+
+
+def evict_cache_folder(folder, max_bytes):
+    """
+    Remove the least recently used entries until the folder holds at most max_bytes.
+    An entry is every file whose name starts with the same cache key.
+    """
+    entries = {}
+    with os.scandir(folder) as scan:
+        for entry in scan:
+            if entry.name.endswith(".tmp"):
+                continue
+            cache_key = entry.name.split("_", 1)[0].split(".", 1)[0]
+            stat = entry.stat()
+            size, last_used, paths = entries.get(cache_key, (0, 0, []))
+            entries[cache_key] = (size + stat.st_size, max(last_used, stat.st_mtime), paths + [entry.path])
+
+    total = sum(size for size, _, _ in entries.values())
+    for size, _, paths in sorted(entries.values(), key=lambda item: item[1]):
+        if total <= max_bytes:
+            break
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+def increment_counters(increments):
+    """
+    Add to the metrics served on /metrics, {(name, labels): amount}, in one transaction.
+    They live in the queue database so that /metrics counts every web worker's conversions.
+    """
+    with closing(get_jobs_db()) as db:
+        db.executemany(
+            "INSERT INTO counters (name, labels, value) VALUES (?, ?, ?)"
+            " ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value",
+            [(name, labels, amount) for (name, labels), amount in increments.items()],
+        )
+
+
+def read_counters(name):
+    """The values of a metric by label set."""
+    with closing(get_jobs_db()) as db:
+        return dict(db.execute("SELECT labels, value FROM counters WHERE name = ?", (name,)).fetchall())
+
+
+# Upper bounds in seconds of the cumulative stage duration histogram buckets
+STAGE_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def stage_recorder(timings):
+    """A timer for generate_extracted_pdf that stores each stage's duration in the timings dict."""
+    @contextmanager
+    def timer(stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[stage] = time.perf_counter() - started
+    return timer
+
+
+def observe_stage_timings(timings):
+    increments = {}
+    for stage, seconds in timings.items():
+        labels = f'stage="{stage}"'
+        for bound in STAGE_DURATION_BUCKETS:
+            if seconds <= bound:
+                increments["pdfdata_stage_duration_seconds_bucket", f'{labels},le="{bound}"'] = 1
+        increments["pdfdata_stage_duration_seconds_sum", labels] = seconds
+        increments["pdfdata_stage_duration_seconds_count", labels] = 1
+    increment_counters(increments)
+
+
+def count_conversion_error(error):
+    if isinstance(error, ConversionTimeout):
+        reason = "timeout"
+    elif isinstance(error, (BrokenProcessPool, ConversionCrashed)):
+        reason = "crash"
+    else:
+        reason = "error"
+    increment_counters({("pdfdata_conversion_errors_total", f'reason="{reason}"'): 1})
+
+
+def timed_conversion(source, output, engine=None, job_id=None, disk=True):
+    """
+    Run generate_extracted_pdf and return its metrics with the duration of every stage;
+    with a job_id, the stages the conversion completes are recorded on that job.
+    """
+    timings = {}
+    started = time.perf_counter()
+    metrics = generate_extracted_pdf(source, output, engine, stage_recorder(timings), job_progress(job_id), disk)
+    timings["total"] = time.perf_counter() - started
+    return metrics, timings
+
+
+class ConversionTimeout(BaseException):
+    """
+    Raised from SIGALRM when a conversion runs past CONVERSION_TIMEOUT. A BaseException,
+    so the extractors' "except Exception" fallbacks cannot swallow it and let a report
+    with missing parts be cached as done.
+    """
+
+
+class ConversionCrashed(Exception):
+    pass
+
+
+# Seconds past CONVERSION_TIMEOUT after which the web worker kills a conversion process that
+# did not stop at its SIGALRM, e.g. because it is stuck inside MuPDF's C code
+CONVERSION_TIMEOUT_GRACE = 10
+
+
+def _raise_conversion_timeout(signum, frame):
+    raise ConversionTimeout("Conversion timed out")
+
+
+def _convert_in_subprocess(source, output, engine, timeout, job_id, disk=True):
+    """
+    Runs inside a pool process. The timeout is enforced with SIGALRM so a stuck
+    report is interrupted and the process is free for the next job. Returns the
+    metrics, the timings and, when output is a buffer, the report written to this
+    process's copy of it.
+    """
+    signal.signal(signal.SIGALRM, _raise_conversion_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        metrics, timings = timed_conversion(source, output, engine, job_id, disk)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    return metrics, timings, None if isinstance(output, str) else output.getvalue()
+
+
+def _send_conversion_result(sender, *args):
+    """Runs as a process of its own (see convert_isolated): sends back ("ok", result) or ("error", exception)."""
+    try:
+        result = ("ok", _convert_in_subprocess(*args))
+    except BaseException as e:
+        result = ("error", e)
+    try:
+        sender.send(result)
+    except Exception:
+        # The exception does not pickle
+        sender.send(("error", RuntimeError(repr(result[1]))))
+
+
+def convert_isolated(source, output, engine, job_id, disk=True):
+    """
+    Convert one report in a process of its own and return what _convert_in_subprocess
+    returns. A crash
+    raises ConversionCrashed and is then certainly this report's doing; a process still
+    running CONVERSION_TIMEOUT_GRACE seconds past its timeout is killed.
+    """
+    context = multiprocessing.get_context("forkserver")
+    receiver, sender = context.Pipe(duplex=False)
+    timeout = app.config['CONVERSION_TIMEOUT']
+    process = context.Process(target=_send_conversion_result,
+                              args=(sender, source, output, engine, timeout, job_id, disk), daemon=True)
+    process.start()
+    sender.close()
+    try:
+        if not receiver.poll(timeout + CONVERSION_TIMEOUT_GRACE):
+            raise ConversionTimeout("Conversion timed out")
+        try:
+            outcome, value = receiver.recv()
+        except EOFError:
+            raise ConversionCrashed("The report crashed its conversion process") from None
+    finally:
+        receiver.close()
+        process.kill()
+        process.join()
+    if outcome == "error":
+        raise value
+    return value
+
+
+_pool_lock = threading.Lock()
+_conversion_pool = None
+# Pool processes fork from a forkserver that imported this module once, instead of each importing it
+multiprocessing.set_forkserver_preload([__name__])
+
+
+def get_conversion_pool():
+    global _conversion_pool
+    with _pool_lock:
+        if _conversion_pool is None:
+            # forkserver: pool processes are not forked from this multi-threaded worker
+            _conversion_pool = ProcessPoolExecutor(
+                max_workers=max(1, app.config['CONVERSION_WORKERS']),
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+        return _conversion_pool
+
+
+def reset_conversion_pool(broken_pool, kill=False):
+    """Replace a broken pool; with kill, its processes are killed first, which breaks it for every job it runs."""
+    global _conversion_pool
+    with _pool_lock:
+        if _conversion_pool is broken_pool:
+            _conversion_pool = None
+    if kill:
+        # ProcessPoolExecutor has no public way to stop a process that is stuck in C code
+        for process in list((broken_pool._processes or {}).values()):
+            process.kill()
+    broken_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def run_conversion(source, output, engine=None, job_id=None, isolated=False, disk=True):
+    """
+    Convert one report with the configured executor and return its metrics, raising on
+    failure or timeout. source, output and disk are as for generate_extracted_pdf. The stages
+    the conversion of job_id completes are recorded on the job.
+    Conversions share the process pool, where a report that crashes or hangs its process
+    breaks the pool and raises BrokenProcessPool for every job in it; isolated runs the
+    report in a process of its own instead (see convert_isolated).
+    """
+    if app.config['CONVERSION_EXECUTOR'] != "process":
+        metrics, timings = timed_conversion(source, output, engine, job_id, disk)
+        rendered = None
+    elif isolated:
+        metrics, timings, rendered = convert_isolated(source, output, engine, job_id, disk)
+    else:
+        # Stage timings are measured in the pool process and recorded here, where /metrics can see them
+        pool = get_conversion_pool()
+        timeout = app.config['CONVERSION_TIMEOUT']
+        future = pool.submit(_convert_in_subprocess, source, output, engine, timeout, job_id, disk)
+        try:
+            metrics, timings, rendered = future.result(timeout=timeout + CONVERSION_TIMEOUT_GRACE)
+        except FuturesTimeoutError:
+            # The process did not stop at its SIGALRM; the other jobs in the pool are retried
+            reset_conversion_pool(pool, kill=True)
+            raise ConversionTimeout("Conversion timed out") from None
+        except BrokenProcessPool:
+            # A report crashed a pool process; start a fresh pool for the remaining jobs
+            reset_conversion_pool(pool)
+            raise
+
+    if rendered is not None:
+        output.write(rendered)
+    observe_stage_timings(timings)
+    return metrics
+
+
+def conversion_worker():
+    while True:
+        job = claim_next_job()
+        if job is None:
+            time.sleep(app.config['QUEUE_POLL_INTERVAL'])
+            continue
+        requeued = False
+        try:
+            # An identical upload may have been converted since this job was queued
+            if not os.path.exists(job["output_path"]):
+                rendered_path = f"{job['output_path']}.{job['id']}.tmp"
                 try:
-                    a_minus_b_values = [
-                        float(cell) for row in table_3 for cell in row if cell and cell.replace('.', '', 1).isdigit()
-                    ]
-                    if len(a_minus_b_values) >= 2:
-                        a_minus_b_left, a_minus_b_right = a_minus_b_values[:2]
-                except ValueError as e:
-                    print(f"Error parsing A/-B values: {e}")
-
-        # Fallback: Extract from raw text if tables are missing or incomplete
-        if any(val == "Not Found" for val in [distraction_left, distraction_right, a_minus_b_left, a_minus_b_right]):
-            page_text = seventh_page.extract_text()
-            print("Extracted Text:", page_text)  # Debug: Analyze raw text
-            if page_text:
-                lines = page_text.split('\n')
-                numeric_rows = []
-                for line in lines:
-                    try:
-                        numeric_values = [float(value) for value in line.split() if value.replace('.', '', 1).isdigit()]
-                        if numeric_values:
-                            numeric_rows.append(numeric_values)
-                    except ValueError:
-                        continue
-
-                # Dynamically assign missing values if numeric rows exist
-                if len(numeric_rows) > 1:
-                    if distraction_left == "Not Found" and len(numeric_rows[0]) > 0:
-                        distraction_left = numeric_rows[0][0]
-                    if distraction_right == "Not Found" and len(numeric_rows[1]) > 0:
-                        distraction_right = numeric_rows[1][0]
-                    if len(numeric_rows) > 2:
-                        if a_minus_b_left == "Not Found" and len(numeric_rows[2]) > 0:
-                            a_minus_b_left = numeric_rows[2][0]
-                        if a_minus_b_right == "Not Found" and len(numeric_rows[3]) > 0:
-                            a_minus_b_right = numeric_rows[3][0]
-
-    table_7_1 = pd.DataFrame([
-        {"Metric": "Distraction Left", "Value": distraction_left},
-        {"Metric": "Distraction Right", "Value": distraction_right}
-    ])
+                    # A job that was interrupted before runs alone, so a report that crashes is only its own failure
+                    metrics = run_conversion(job["input_path"], rendered_path, job["engine"], job["id"],
+                                             isolated=job["attempts"] > 0)
+                    store_cached_result(job["cache_key"], rendered_path, metrics.as_dict())
+                finally:
+                    if os.path.exists(rendered_path):
+                        os.remove(rendered_path)
+            finish_job(job["id"])
+        except BrokenProcessPool:
+            # Some report in the pool crashed or hung it; this one is retried on its own
+            requeue_job(job["id"])
+            requeued = True
+        except (Exception, ConversionTimeout) as e:
+            print(f"Error converting {job['filename']}: {e!r}")
+            count_conversion_error(e)
+            finish_job(job["id"], error=str(e) or type(e).__name__)
+        finally:
+            # The upload is only needed for this job; the result lives in the cache
+            if not requeued and os.path.exists(job["input_path"]):
+                os.remove(job["input_path"])
+
+
+_workers_lock = threading.Lock()
+_workers_pid = None
+
+
+def start_conversion_workers():
+    """
+    Start the background conversion threads for this process. Called lazily so that
+    every forked gunicorn worker gets its own threads.
+    """
+    global _workers_pid
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        # One thread per conversion slot keeps the pool saturated while jobs are queued
+        for _ in range(app.config['CONVERSION_WORKERS']):
+            threading.Thread(target=conversion_worker, daemon=True).start()
+        threading.Thread(target=maintain_queue, daemon=True).start()
+        _workers_pid = os.getpid()
 
-    table_7_2 = pd.DataFrame([
-        {"Metric": "A/-B Left", "Value": a_minus_b_left},
-        {"Metric": "A/-B Right", "Value": a_minus_b_right}
-    ])
-    return table_7_1, table_7_2
-
-def extract_data_from_page_8(pdf_path):
-    avg_a_left = "Not Found"
-    avg_a_right = "Not Found"
-    plus_b_left = "Not Found"
-    plus_b_right = "Not Found"
-    diff_ratio_la_ra = "Not Found"
-    diff_ratio_plus_b_ce = "Not Found"
-    amp_symmetry = "Not Found"
-    l_r_sympathy = "Not Found"
-
-    with pdfplumber.open(pdf_path) as pdf:
-        eighth_page = pdf.pages[7]
-        page_text = eighth_page.extract_text()
-
-        if page_text:
-            lines = page_text.split('\n')
-            numeric_values = []
-            for line in lines:
-                words = line.split()
-                for word in words:
-                    if word.replace('.', '', 1).isdigit() or '%' in word:
-                        numeric_values.append(word)
-
-            if len(numeric_values) >= 8:
-                avg_a_left = numeric_values[0]
-                avg_a_right = numeric_values[4]
-                plus_b_left = numeric_values[1]
-                plus_b_right = numeric_values[5]
-                diff_ratio_la_ra = numeric_values[2]
-                diff_ratio_plus_b_ce = numeric_values[3]
-                amp_symmetry = numeric_values[6]
-                l_r_sympathy = numeric_values[7]
-
-    # Return two separate DataFrames
-    table_8_1 = pd.DataFrame([
-        {"Metric": "Avg. A (Left)", "Value": avg_a_left},
-        {"Metric": "Avg. A (Right)", "Value": avg_a_right},
-        {"Metric": "+B (Left)", "Value": plus_b_left},
-        {"Metric": "+B (Right)", "Value": plus_b_right},
-        {"Metric": "Diff. Ratio La - Ra", "Value": diff_ratio_la_ra},
-        {"Metric": "Diff. Ratio +B (CE)", "Value": diff_ratio_plus_b_ce}
-    ])
 
-    table_8_2 = pd.DataFrame([
-        {"Metric": "Amp. Symmetry", "Value": amp_symmetry},
-        {"Metric": "L-R Sympathy", "Value": l_r_sympathy}
-    ])
+@app.before_request
+def ensure_conversion_workers():
+    start_conversion_workers()
+
+
+def wants_json():
+    best = request.accept_mimetypes.best_match(['application/json', 'text/html'])
+    return best == 'application/json'
+
+
+def requested_engine():
+    """The extraction engine picked by the request's 'engine' field, or the configured default."""
+    return request.values.get('engine') or app.config['EXTRACTION_ENGINE']
+
+
+def client_id():
+    """Who the request comes from, for the fair queue: its CLIENT_ID_HEADER header if set, else its address."""
+    header = app.config['CLIENT_ID_HEADER']
+    return (header and request.headers.get(header)) or request.remote_addr or ""
+
+
+def stream_size(stream):
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(0)
+    return size
+
+
+def count_pages(stream):
+    """
+    Page count of an uploaded PDF, read from its page tree without laying out any page,
+    and 0 when it cannot be opened (its conversion fails later); rewinds the stream.
+    """
+    try:
+        with fitz.open(stream=stream.read(), filetype="pdf") as pdf:
+            return pdf.page_count
+    except RuntimeError:
+        return 0
+    finally:
+        stream.seek(0)
+
+
+def uncached_pages(stream, cache_key):
+    """
+    Pages of an upload that have to be converted: 0 when its report is in the result
+    cache, so that a cache hit is never opened just to be counted.
+    """
+    return 0 if lookup_cached_result(cache_key, count=False) else count_pages(stream)
 
-    return table_8_1, table_8_2
-
-def extract_data_from_page_9(pdf_path):
-    sum_value = "Not Found"
-    average = "Not Found"
-    max_dev = "Not Found"
-    std_dev = "Not Found"
-
-    with pdfplumber.open(pdf_path) as pdf:
-        ninth_page = pdf.pages[8]
-        ninth_page_tables = ninth_page.extract_tables()
-
-        if ninth_page_tables:
-            table = ninth_page_tables[0]
-            extracted_values = []
-            for row in table:
-                for cell in row:
-                    if cell:
-                        values = cell.split()
-                        for value in values:
-                            if value.replace('.', '', 1).isdigit():
-                                extracted_values.append(float(value))
-
-            if len(extracted_values) >= 4:
-                sum_value = extracted_values[0]
-                average = extracted_values[1]
-                max_dev = extracted_values[2]
-                std_dev = extracted_values[3]
-
-        if sum_value == "Not Found":
-            page_text = ninth_page.extract_text()
-            if page_text:
-                lines = page_text.split('\n')
-                numeric_values = []
-                for line in lines:
-                    words = line.split()
-                    for word in words:
-                        if word.replace('.', '', 1).isdigit():
-                            numeric_values.append(float(word))
-
-                if len(numeric_values) >= 4:
-                    sum_value = numeric_values[0]
-                    average = numeric_values[1]
-                    max_dev = numeric_values[2]
-                    std_dev = numeric_values[3]
-
-    return pd.DataFrame([
-        {"Metric": "Sum", "Value": sum_value},
-        {"Metric": "Average", "Value": average},
-        {"Metric": "Max Dev", "Value": max_dev},
-        {"Metric": "Std Dev", "Value": std_dev}
-    ])
 
-def add_table_to_pdf(pdf, data_frame, title, y_position):
-    """
-    Adds a table to the PDF without column titles.
-    :param pdf: The ReportLab canvas
-    :param data_frame: Pandas DataFrame to render as a table
-    :param title: Title of the section
-    :param y_position: Current Y-position on the PDF
-    :return: Updated Y-position after rendering the table
-    """
-    if y_position < 100:  # Start a new page if there's not enough space
-        pdf.showPage()
-        pdf.setFont("Helvetica", 12)
-        y_position = 750
-
-    # Add the title
-    pdf.drawString(100, y_position, title)
-    y_position -= 20
-
-    # Convert DataFrame to list of lists for ReportLab, excluding column titles
-    table_data = data_frame.values.tolist()
-
-    # Create the table
-    table = Table(table_data)
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, -1), colors.beige),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-    ]))
-
-    # Calculate table height
-    table_width, table_height = table.wrap(500, y_position)
-    if y_position - table_height < 50:  # Start a new page if table doesn't fit
-        pdf.showPage()
-        pdf.setFont("Helvetica", 12)
-        y_position = 750
-
-    # Draw the table
-    table.drawOn(pdf, 100, y_position - table_height)
-    y_position -= table_height + 30  # Adjust position for the next element
-
-    return y_position
-
-def add_table_with_image_to_pdf(pdf, data_frame, title, y_position, image_path=None):
-    """
-    Adds an image to the PDF first, followed by a table if provided.
-    :param pdf: The ReportLab canvas
-    :param data_frame: Pandas DataFrame to render as a table
-    :param title: Title of the section
-    :param y_position: Current Y-position on the PDF
-    :param image_path: Path to the image to insert
-    :return: Updated Y-position after rendering the image and table
-    """
-    if y_position < 200:  # Start a new page if not enough space for the image
-        pdf.showPage()
-        pdf.setFont("Helvetica", 12)
-        y_position = 750
-
-    # Add the title
-    pdf.drawString(100, y_position, title)
-    y_position -= 20
-
-    # Add the image first, if provided
-    if image_path:
-        pdf.drawImage(image_path, 100, y_position - 150, width=200, height=150)
-        y_position -= 170
-
-    # Add the table
-    if data_frame is not None:
-        # Convert DataFrame to list of lists for ReportLab
-        table_data = data_frame.values.tolist()
-
-        # Create the table
-        table = Table(table_data)
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), colors.beige),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ]))
-
-        # Calculate table height
-        table_width, table_height = table.wrap(500, y_position)
-        if y_position - table_height < 50:  # Start a new page if the table doesn't fit
-            pdf.showPage()
-            pdf.setFont("Helvetica", 12)
-            y_position = 750
-
-        # Draw the table
-        table.drawOn(pdf, 100, y_position - table_height)
-        y_position -= table_height + 20
-
-    return y_position
+def retry_after(in_flight_jobs):
+    """
+    Seconds a turned-away client should wait: the in-flight jobs at the mean conversion
+    time, spread over the conversion slots of every web worker, between 1 s and 10 min.
+    """
+    count = read_counters("pdfdata_stage_duration_seconds_count").get('stage="total"')
+    mean = read_counters("pdfdata_stage_duration_seconds_sum")['stage="total"'] / count if count else 1.0
+    slots = WEB_CONCURRENCY * max(1, app.config['CONVERSION_WORKERS'])
+    return min(600, max(1, math.ceil(in_flight_jobs * mean / slots)))
+
+
+# Admission limits: (per-request setting, in-flight setting, what they count)
+ADMISSION_LIMITS = [
+    ("MAX_REQUEST_FILES", "MAX_INFLIGHT_JOBS", "reports"),
+    ("MAX_REQUEST_BYTES", "MAX_INFLIGHT_BYTES", "bytes"),
+    ("MAX_REQUEST_PAGES", "MAX_INFLIGHT_PAGES", "pages"),
+]
+
+
+def admission_error(files, size, pages):
+    """
+    Check a request of files reports, size bytes and pages pages against the admission
+    limits. Returns None to admit it, else the response to send: 413 when the request
+    alone is over a limit, or 429 with Retry-After when the queue has no room for it yet.
+    An empty queue takes any request within the request limits. The in-flight totals are
+    read without a lock, so concurrent requests can each be admitted into the same room.
+    """
+    with closing(get_jobs_db()) as db:
+        in_flight = db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(pages), 0) FROM jobs"
+            " WHERE status IN ('queued', 'running')"
+        ).fetchone()
+    for (request_setting, in_flight_setting, unit), requested, queued in zip(ADMISSION_LIMITS, (files, size, pages),
+                                                                             in_flight):
+        limit = app.config[request_setting]
+        if limit and requested > limit:
+            increment_counters({("pdfdata_admission_rejections_total", f'limit="{request_setting}"'): 1})
+            return f"A request can carry at most {limit} {unit}", 413
+        limit = app.config[in_flight_setting]
+        if limit and in_flight[0] and queued + requested > limit:
+            increment_counters({("pdfdata_admission_rejections_total", f'limit="{in_flight_setting}"'): 1})
+            return (f"The conversion queue is full ({queued} {unit} in flight); try again later", 429,
+                    {'Retry-After': str(retry_after(in_flight[0]))})
+    return None
 
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
+        # Turn away what the limits would refuse anyway before the form data is parsed
+        if request.content_length is None:
+            return "Content-Length header required", 411
+        rejected = admission_error(0, request.content_length, 0)
+        if rejected:
+            return rejected
+
         if 'pdf_files' not in request.files:
             return "No files part"
 
@@ -437,285 +1924,702 @@ def index():
         if not files or all(file.filename == '' for file in files):
             return "No files selected"
 
-        extracted_pdfs = []  # Store paths for extracted PDFs
-
         for file in files:
             if not file.filename.lower().endswith('.pdf'):
                 return f"{file.filename} is not a valid PDF"
 
-            # Save uploaded file
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-            file.save(file_path)
-
-            # Generate extracted PDF
-            output_filename = file.filename.replace('.pdf', '_extracted.pdf')
-            output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
-            generate_extracted_pdf(file_path, output_path)
-
-            # Add the static path for rendering in HTML
-            extracted_pdfs.append({
-                'filename': file.filename,
-                'pdf_path': f"/static/extracted_pdfs/{output_filename}"
-            })
-
-        return render_template('index.html', extracted_pdfs=extracted_pdfs)
-
-    return render_template('index.html', extracted_pdfs=[])
-
-
-def generate_extracted_pdf(input_path, output_path):
-    # Extract data and images for the specific file
-    extracted_data = extract_name_and_dob(input_path)
-    images = extract_images(input_path)
-    page_4_data = extract_data_from_page_4(input_path)
-    page_5_table_1, page_5_table_2 = extract_data_from_page_5(input_path)
-    page_6_data = extract_data_from_page_6(input_path)
-    page_7_table_1, page_7_table_2 = extract_data_from_page_7(input_path)
-    page_8_table_1, page_8_table_2 = extract_data_from_page_8(input_path)
-    page_9_data = extract_data_from_page_9(input_path)
-
-    # Access individual images
-    imagefrompage5 = images.get("imagefrompage5")
-    imagefrompage6 = images.get("imagefrompage6")
-    imagefrompage9 = images.get("imagefrompage9")
-
-    # Create PDF
-    pdf = canvas.Canvas(output_path, pagesize=letter)
-    pdf.setFont("Helvetica", 12)
-
-    # Helper functions
-    def draw_title(pdf, text, y_position):
-        pdf.setFont("Helvetica-Bold", 14)
-        pdf.drawCentredString(300, y_position, text)
-        return y_position - 20
-
-    def add_section_title(pdf, text, y_position):
-        pdf.setFont("Helvetica-Bold", 12)
-        pdf.drawString(75, y_position, text)
-        return y_position - 10
-
-    def add_divider(pdf, y_position):
-        """
-        Draws a divider line to separate sections.
-        """
-        pdf.setLineWidth(0.5)
-        pdf.setStrokeColor(colors.black)
-        pdf.line(50, y_position, 550, y_position)
-        return y_position - 15
+        engine = requested_engine()
+        if engine not in EXTRACTION_ENGINES:
+            return f"Unknown extraction engine {engine}", 400
 
-    def add_divider1(pdf, y_position):
-        """
-        Draws a divider line to separate sections.
-        """
-        pdf.setLineWidth(0.1)
-        pdf.setStrokeColor(colors.white)
-        pdf.line(50, y_position, 550, y_position)
-        return y_position - 20
-    
-    def add_table_with_style(pdf, data_frame, y_position):
-        if data_frame is None or data_frame.empty:
-            return y_position
-
-        # Convert DataFrame to List for Table
-        table_data = data_frame.values.tolist()
-
-        # Create Table
-        table = Table(table_data)
-        table.setStyle(TableStyle([
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ]))
-
-        # Calculate table size
-        table_width, table_height = table.wrap(450, y_position)
-        if y_position - table_height < 50:  # Start a new page if the table doesn't fit
-            pdf.showPage()
-            pdf.setFont("Helvetica", 12)
-            y_position = 750
-
-        table.drawOn(pdf, 75, y_position - table_height)
-        return y_position - table_height - 18
-
-    def add_image_with_label(pdf, image_path, y_position):
-        if image_path:
-            if y_position < 250:  # Check for space
-                pdf.showPage()
-                pdf.setFont("Helvetica", 12)
-                y_position = 750
-            pdf.drawImage(image_path, 75, y_position - 150, width=300, height=150)
-            y_position -= 170
-        return y_position
-
-    def add_image_with_table_right(pdf, image_path, data_frame, y_position, label=""):
-        """
-        Adds an image on the left and a table on the right side-by-side in the PDF.
-        :param pdf: The ReportLab canvas
-        :param image_path: Path to the image to insert
-        :param data_frame: Pandas DataFrame to render as a table
-        :param y_position: Current Y-position on the PDF
-        :param label: Optional label for the image
-        :return: Updated Y-position after rendering the image and table
-        """
-        if y_position < 200:  # Start a new page if space is insufficient
-            pdf.showPage()
-            pdf.setFont("Helvetica", 12)
-            y_position = 750
-
-        # Draw the label (if provided)
-        if label:
-            pdf.setFont("Helvetica-Bold", 12)
-            pdf.drawString(100, y_position, label)
-            y_position -= 20
-
-        # Draw the image on the left
-        img_width, img_height = 200, 150
-        pdf.drawImage(image_path, 100, y_position - img_height, width=img_width, height=img_height)
-
-        # Convert DataFrame to list of lists for ReportLab (exclude headers)
-        table_data = data_frame.values.tolist()
-
-        # Create the table
-        table = Table(table_data, colWidths=[100, 100])
-        table.setStyle(TableStyle([
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ]))
-
-        # Calculate table height
-        table_width, table_height = table.wrap(200, y_position)
-        table_x = 350  # Position table to the right of the image
-
-        # Ensure space for both image and table
-        if y_position - max(img_height, table_height) < 50:
-            pdf.showPage()
-            pdf.setFont("Helvetica", 12)
-            y_position = 750
-            pdf.drawImage(image_path, 100, y_position - img_height, width=img_width, height=img_height)
-            table_x = 350
-            y_position -= img_height
-
-        # Draw the table
-        table.drawOn(pdf, table_x, y_position - table_height)
-
-        # Adjust y_position based on the larger of image/table height
-        y_position -= max(img_height, table_height) + 20
-
-        return y_position
-
-    def add_page_5_table_2_with_layout(pdf, data_frame, y_position):
-        """
-        Adds the modified `page_5_table_2` table with additional layout changes.
-        :param pdf: The ReportLab canvas
-        :param data_frame: Pandas DataFrame to render as a table
-        :param y_position: Current Y-position on the PDF
-        :return: Updated Y-position after rendering the table
-        """
-        # Add a title for the section
-        y_position = add_section_title(pdf, "3. Changes in EEG During Opening and Closing", y_position)
-
-        # Ensure enough space for the table
-        if y_position < 150:  # Start a new page if space is insufficient
-            pdf.showPage()
-            pdf.setFont("Helvetica", 12)
-            y_position = 750
-
-        # Modify the table layout
-        new_columns = [["OE1/CE.", "Left"], ["OE1/CE", "Right"], ["OE2/CE", "Left"], ["OE2/CE", "Right"], ["OE2/CE", "Right"]]
-        top_row = ["Div.", "Side", "δ", "θ", "α", "SMR", "-β", "+β"]
-
-        # Convert DataFrame to list of lists
-        table_data = data_frame.values.tolist()
-
-        # Insert new columns into table rows
-        modified_table = []
-        for i, row in enumerate(table_data):
-            new_column_values = new_columns[i] if i < len(new_columns) else ["", ""]
-            modified_table.append(new_column_values + row)
-
-        # Add the new top row
-        modified_table.insert(0, top_row)
-
-        # Create the table
-        table = Table(modified_table)
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),  # Header row
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ]))
-
-        # Calculate table height
-        table_width, table_height = table.wrap(500, y_position)
-        if y_position - table_height < 100:  # Start a new page if the table doesn't fit
-            pdf.showPage()
-            pdf.setFont("Helvetica", 12)
-            y_position = 750
-
-        # Draw the table on the PDF
-        table.drawOn(pdf, 100, y_position - table_height)
-        y_position -= table_height + 20
-
-        # Add a divider after the table
-        y_position = add_divider(pdf, y_position)
-
-        return y_position
-
-    
-
-    # Start generating PDF content
-    y_position = 750
-    y_position = draw_title(pdf, "Brain Health EEG Report", y_position)
-    pdf.drawString(75, y_position, f"Name: {extracted_data['name']}")
-    y_position -= 20
-    pdf.drawString(75, y_position, f"DOB: {extracted_data['dob']}")
-    y_position = add_divider1(pdf, y_position)
-
-    # Add sections with tables and images
-    y_position = add_section_title(pdf, "1. Frequency Appearance Rate and Average Amplitude", y_position)
-    y_position = add_table_with_style(pdf, page_4_data, y_position)
-    y_position = add_divider(pdf, y_position)
-
-    y_position = add_section_title(pdf, "2. The Change in Power of Alpha Waves", y_position)
-    y_position = add_image_with_label(pdf, imagefrompage5[1:], y_position)
-    # y_position = add_table_with_style(pdf, page_5_table_1, y_position)
-    y_position = add_divider(pdf, y_position)
-
-    y_position = add_page_5_table_2_with_layout(pdf, page_5_table_2, y_position)
-
-    y_position = add_section_title(pdf, "4. Brain arousal level (0/SMR)", y_position)
-    y_position = add_image_with_label(pdf, imagefrompage6[1:], y_position)
-    y_position = add_divider(pdf, y_position)
-
-    y_position = add_section_title(pdf, "5. Physical Tension and Stress", y_position)
-    y_position = add_table_with_style(pdf, page_6_data, y_position)
-    y_position = add_divider(pdf, y_position)
-
-    y_position = add_section_title(pdf, "6. Mental Distraction and Stress", y_position)
-    y_position = add_table_with_style(pdf, page_7_table_1, y_position)
-    y_position = add_divider(pdf, y_position)
-
-    y_position = add_section_title(pdf, "7. Behavioral Propensity (a/-B)", y_position)
-    y_position = add_table_with_style(pdf, page_7_table_2, y_position)
-    y_position = add_divider(pdf, y_position)
-
-    y_position = add_section_title(pdf, "8. Emotional Propensity (La- Ra)", y_position)
-    y_position = add_table_with_style(pdf, page_8_table_1, y_position)
-    y_position = add_divider(pdf, y_position)
-
-    y_position = add_section_title(pdf, "9. Balance Between Left and Right Brain", y_position)
-    y_position = add_table_with_style(pdf, page_8_table_2, y_position)
-    y_position = add_divider(pdf, y_position)
-
-    y_position = add_section_title(pdf, "10. Self-feedback Ability", y_position)
-    y_position = add_image_with_table_right(pdf, imagefrompage9[1:], page_9_data, y_position)
-
-
-    pdf.save()
+        cache_keys = [upload_cache_key(file.stream, engine) for file in files]
+        pages = [uncached_pages(file.stream, cache_key) for file, cache_key in zip(files, cache_keys)]
+        rejected = admission_error(len(files), sum(stream_size(file.stream) for file in files), sum(pages))
+        if rejected:
+            return rejected
+
+        batch_id = uuid.uuid4().hex
+        client = client_id()
+        job_ids = [enqueue_upload(batch_id, file.filename, file.stream, engine, file.save, client, file_pages,
+                                  cache_key=cache_key)
+                   for file, file_pages, cache_key in zip(files, pages, cache_keys)]
+
+        jobs = [job_to_dict(get_job(job_id)) for job_id in job_ids]
+        if wants_json():
+            return jsonify({'batch_id': batch_id, 'jobs': jobs,
+                            'events_url': url_for('batch_events', batch_id=batch_id)}), 202
+        return render_template('index.html', jobs=jobs, batch_id=batch_id), 202
+
+    return render_template('index.html', jobs=[])
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job_to_dict(job))
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = get_job(job_id)
+    if job is None:
+        abort(404)
+    if job["status"] != "done":
+        return jsonify(job_to_dict(job)), 409
+    if not os.path.exists(job["output_path"]):
+        # Evicted from the result cache since the job finished
+        abort(410)
+    download_name = job["filename"].replace('.pdf', '_extracted.pdf')
+    return send_file(os.path.abspath(job["output_path"]), mimetype='application/pdf', download_name=download_name)
+
+
+class ZipStream(io.RawIOBase):
+    """Write-only, unseekable file for ZipFile that hands back what was written since the last drain."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+# Conversion timeouts past the newest job of a batch after which its ZIP download and
+# progress stream stop waiting for the jobs still queued or running
+BATCH_STREAM_TIMEOUTS = 5
+
+
+def batch_stream_deadline(jobs):
+    """The time.time() at which a stream following these jobs of a batch gives up on them."""
+    return max(job["created_at"] for job in jobs) + BATCH_STREAM_TIMEOUTS * app.config['CONVERSION_TIMEOUT']
+
+
+def stream_batch_zip(batch_id):
+    """
+    Yield a ZIP archive of the batch's reports piece by piece. Each report is added
+    as soon as its job finishes and metrics.csv is added last; only one read buffer
+    of a report is held in memory at a time. Jobs still unfinished at the
+    batch_stream_deadline are left out, and listed in metrics.csv as unfinished.
+    """
+    stream = ZipStream()
+    finished = set()
+    entry_names = set()
+    rows = []
+    with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+        while True:
+            jobs = get_batch_jobs(batch_id)
+            for job in jobs:
+                if job["id"] in finished or job["status"] not in ("done", "failed"):
+                    continue
+                finished.add(job["id"])
+                row = {"filename": job["filename"], "status": job["status"], "error": job["error"] or ""}
+                cached = lookup_cached_result(job["cache_key"], count=False) if job["status"] == "done" else None
+                if cached:
+                    pdf_path, metrics = cached
+                    row.update(metrics)
+                    entry_name = job["filename"].replace('.pdf', '_extracted.pdf')
+                    base_name, extension = os.path.splitext(entry_name)
+                    copy = 2
+                    while entry_name in entry_names:
+                        entry_name = f"{base_name} ({copy}){extension}"
+                        copy += 1
+                    entry_names.add(entry_name)
+                    with open(pdf_path, "rb") as report, archive.open(entry_name, "w") as entry:
+                        for chunk in iter(lambda: report.read(64 * 1024), b""):
+                            entry.write(chunk)
+                            yield stream.drain()
+                elif job["status"] == "done":
+                    row.update(status="failed", error="Result expired from the cache")
+                rows.append(row)
+                yield stream.drain()
+
+            if len(finished) == len(jobs):
+                break
+            if time.time() >= batch_stream_deadline(jobs):
+                rows += [{"filename": job["filename"], "status": job["status"],
+                          "error": "Not finished in time for this download"}
+                         for job in jobs if job["id"] not in finished]
+                break
+            time.sleep(app.config['QUEUE_POLL_INTERVAL'])
+
+        columns = ["filename", "status", "error"]
+        for row in rows:
+            columns += [column for column in row if column not in columns]
+        metrics_csv = io.StringIO()
+        writer = csv.DictWriter(metrics_csv, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+        archive.writestr("metrics.csv", metrics_csv.getvalue())
+    yield stream.drain()
+
+
+@app.route('/batches/<batch_id>/download.zip')
+def batch_zip(batch_id):
+    if not get_batch_jobs(batch_id):
+        abort(404)
+    return Response(
+        stream_batch_zip(batch_id),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename=extracted_{batch_id}.zip'},
+    )
+
+
+def stream_batch_events(batch_id):
+    """
+    Yield the batch's progress as server-sent events: a "job" event with the job's
+    job_to_dict whenever its status or stage changes (finished jobs carry their pdf_path
+    and metrics), then one "end" event once every job has finished, or once the
+    batch_stream_deadline has passed with jobs still unfinished. A comment is sent
+    after EVENTS_KEEPALIVE quiet seconds so idle proxies keep the stream open.
+    """
+    sent = {}
+    last_sent = time.monotonic()
+    while True:
+        jobs = get_batch_jobs(batch_id)
+        for job in jobs:
+            state = (job["status"], job["stage"])
+            if sent.get(job["id"]) != state:
+                sent[job["id"]] = state
+                last_sent = time.monotonic()
+                yield f"event: job\ndata: {json.dumps(job_to_dict(job))}\n\n"
+
+        if all(job["status"] in ("done", "failed") for job in jobs) or time.time() >= batch_stream_deadline(jobs):
+            yield "event: end\ndata: {}\n\n"
+            return
+        if time.monotonic() - last_sent >= app.config['EVENTS_KEEPALIVE']:
+            last_sent = time.monotonic()
+            yield ": keep-alive\n\n"
+        time.sleep(app.config['QUEUE_POLL_INTERVAL'])
+
+
+@app.route('/batches/<batch_id>/events')
+def batch_events(batch_id):
+    """
+    Progress of a batch as a text/event-stream, for EventSource. A client that reconnects
+    gets every job's current state again before further changes.
+    """
+    if not get_batch_jobs(batch_id):
+        abort(404)
+    return Response(
+        stream_with_context(stream_batch_events(batch_id)),
+        mimetype='text/event-stream',
+        # No caching, and no buffering by proxies that would hold events back
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+def combined_batch_pdf(jobs):
+    """
+    Merge the finished reports of a batch into one PDF with a bookmark per patient and
+    return its path, or None when none of them is available any more. The merged file
+    is kept in the result cache under a key derived from the reports' cache keys, so it
+    is built once per set of reports. Reports are opened one at a time, and identical
+    fonts and images are stored once in the merged file.
+    """
+    reports = []
+    digest = hashlib.sha256()
+    for job in jobs:
+        cached = lookup_cached_result(job["cache_key"], count=False) if job["status"] == "done" else None
+        if cached:
+            reports.append((job, *cached))
+            digest.update(f"{job['cache_key']}:{job['filename']}\n".encode())
+    if not reports:
+        return None
+
+    combined_path = os.path.join(app.config['RESULT_CACHE_FOLDER'], f"{digest.hexdigest()}_combined.pdf")
+    try:
+        now = time.time()
+        os.utime(combined_path, (now, now))
+        return combined_path
+    except FileNotFoundError:
+        pass
+
+    tmp_path = f"{combined_path}.{uuid.uuid4().hex}.tmp"
+    with fitz.open() as combined:
+        toc = []
+        for job, pdf_path, metrics in reports:
+            name = metrics.get("Name")
+            title = name if name and name not in ("Not found", "Error") else job["filename"]
+            toc.append([1, title, combined.page_count + 1])
+            with fitz.open(pdf_path) as report:
+                combined.insert_pdf(report)
+        combined.set_toc(toc)
+        # garbage=4 merges the duplicate font and image objects every report brings along
+        combined.save(tmp_path, garbage=4, deflate=True)
+    os.replace(tmp_path, combined_path)
+    evict_result_cache()
+    return combined_path
+
+
+@app.route('/batches/<batch_id>/combined.pdf')
+def batch_combined_pdf(batch_id):
+    """All the batch's reports in one PDF, a bookmark per patient; 409 until every job has finished."""
+    jobs = get_batch_jobs(batch_id)
+    if not jobs:
+        abort(404)
+    if any(job["status"] not in ("done", "failed") for job in jobs):
+        return jsonify({'batch_id': batch_id, 'jobs': [job_to_dict(job) for job in jobs]}), 409
+    combined_path = combined_batch_pdf(jobs)
+    if combined_path is None:
+        # Every job failed, or its result was evicted from the cache
+        abort(410)
+    return send_file(os.path.abspath(combined_path), mimetype='application/pdf',
+                     download_name=f"extracted_{batch_id}.pdf")
+
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """
+    Start a resumable upload of one report. Takes a JSON object or form fields, all
+    strings but size: filename and size (bytes) are required; sha256 (hex, checked once the file is complete), engine
+    and the batch_id of an earlier upload to add the report to that batch are optional.
+    The file is then sent in chunks with PATCH to the returned upload_url.
+    """
+    fields = request.get_json(silent=True)
+    if not isinstance(fields, dict):
+        fields = request.values
+    for name in ('filename', 'sha256', 'engine', 'batch_id'):
+        if not isinstance(fields.get(name, ''), str):
+            return f"{name} must be a string", 400
+    filename = fields.get('filename') or ''
+    if not filename.lower().endswith('.pdf'):
+        return f"{filename} is not a valid PDF", 400
+    try:
+        size = int(fields.get('size'))
+    except (TypeError, ValueError):
+        size = 0
+    if size <= 0:
+        return "size must be the file's length in bytes", 400
+    sha256 = fields.get('sha256')
+    if sha256 is not None and not re.fullmatch(r"[0-9a-fA-F]{64}", sha256):
+        return "sha256 must be a hex digest", 400
+    engine = fields.get('engine') or app.config['EXTRACTION_ENGINE']
+    if engine not in EXTRACTION_ENGINES:
+        return f"Unknown extraction engine {engine}", 400
+    batch_id = fields.get('batch_id')
+    if batch_id is not None and not batch_exists(batch_id):
+        abort(404)
+    # Admitted on its declared size; its pages are counted once it is complete
+    rejected = admission_error(1, size, 0)
+    if rejected:
+        return rejected
+
+    expire_upload_sessions()
+    upload_id = uuid.uuid4().hex
+    open(upload_part_path(upload_id), "wb").close()
+    now = time.time()
+    with closing(get_jobs_db()) as db:
+        db.execute(
+            "INSERT INTO uploads (id, batch_id, filename, engine, client, size, sha256, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (upload_id, batch_id or uuid.uuid4().hex, filename, engine, client_id(), size, sha256, now, now),
+        )
+    return jsonify(upload_to_dict(get_upload(upload_id))), 201
+
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'PATCH'])
+def upload_chunk(upload_id):
+    """
+    GET tells a client where to resume: the offset is how many bytes have been stored.
+    PATCH appends the request body at the Upload-Offset header, which must equal that
+    offset (409 otherwise). With an "Upload-Checksum: sha256 <hex>" header the chunk is
+    only stored if it matches; without one, whatever arrived before a dropped connection
+    is kept. The conversion is queued as soon as the last byte is stored, while the
+    client may still be sending the batch's other files.
+    """
+    upload = get_upload(upload_id)
+    if upload is None:
+        abort(404)
+    if request.method == 'GET' or upload["job_id"]:
+        return jsonify(upload_to_dict(upload)), 200 if request.method == 'GET' else 409
+
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        return "Upload-Offset header required", 400
+    if offset != upload["received"]:
+        return jsonify(upload_to_dict(upload)), 409
+    length = request.content_length
+    if length is None:
+        return "Content-Length header required", 411
+    if length > app.config['UPLOAD_CHUNK_MAX_BYTES']:
+        return f"Chunks are limited to {app.config['UPLOAD_CHUNK_MAX_BYTES']} bytes", 413
+    if offset + length > upload["size"]:
+        return "Chunk goes past the declared size", 400
+    expected = None
+    if 'Upload-Checksum' in request.headers:
+        algorithm, _, expected = request.headers['Upload-Checksum'].partition(" ")
+        if algorithm.lower() != "sha256":
+            return "Upload-Checksum must be 'sha256 <hex digest>'", 400
+
+    digest = hashlib.sha256()
+    received = 0
+    with open(upload_part_path(upload_id), "r+b") as part:
+        try:
+            # One writer per upload; a concurrent PATCH of the same upload is turned away
+            fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return jsonify(upload_to_dict(upload)), 409
+        part.seek(offset)
+        try:
+            for chunk in iter(lambda: request.stream.read(64 * 1024), b""):
+                digest.update(chunk)
+                part.write(chunk)
+                received += len(chunk)
+        except ClientDisconnected:
+            pass
+        part.truncate()
+        if expected is not None and (received != length or digest.hexdigest() != expected.strip().lower()):
+            return "Chunk does not match its Upload-Checksum; send it again", 400
+        # Still holding the lock, so no other PATCH can have overwritten the chunk in between
+        with closing(get_jobs_db()) as db:
+            updated = db.execute(
+                "UPDATE uploads SET received = ?, updated_at = ? WHERE id = ? AND received = ?",
+                (offset + received, time.time(), upload_id, offset),
+            ).rowcount
+    upload = get_upload(upload_id)
+    if not updated:
+        return jsonify(upload_to_dict(upload)), 409
+    if upload["received"] == upload["size"]:
+        rejected = complete_upload(upload)
+        if rejected:
+            return rejected
+        upload = get_upload(upload_id)
+    return jsonify(upload_to_dict(upload))
+
+
+@app.route('/convert', methods=['POST'])
+def convert():
+    """
+    Convert a single upload entirely in memory and stream the report back:
+    nothing is written to UPLOAD_FOLDER, not even to the image and OCR caches, which
+    it only uses in memory. The conversion runs with the conversion
+    executor under CONVERSION_TIMEOUT, as a running job that counts against the
+    in-flight limits until it finishes.
+    """
+    file = request.files.get('pdf_file')
+    if file is None or file.filename == '':
+        return "No file selected", 400
+    if not file.filename.lower().endswith('.pdf'):
+        return f"{file.filename} is not a valid PDF", 400
+    engine = requested_engine()
+    if engine not in EXTRACTION_ENGINES:
+        return f"Unknown extraction engine {engine}", 400
+    # Converted right away rather than queued, but only while the queue has room
+    size, pages = stream_size(file.stream), count_pages(file.stream)
+    rejected = admission_error(1, size, pages)
+    if rejected:
+        return rejected
+
+    # Recorded as a running job, so it counts against the in-flight limits while it runs
+    job_id = enqueue_job(uuid.uuid4().hex, file.filename, "", "", "", engine, status="running", client=client_id(),
+                         size=size, pages=pages)
+    source = file.read()
+    output = io.BytesIO()
+    try:
+        try:
+            run_conversion(source, output, engine, job_id, disk=False)
+        except BrokenProcessPool:
+            # Some report in the pool crashed or hung it; this one is retried on its own
+            output = io.BytesIO()
+            run_conversion(source, output, engine, job_id, isolated=True, disk=False)
+    except (Exception, ConversionTimeout) as e:
+        # Almost always an upload that is not a readable report, not a fault of the service
+        print(f"Error converting {file.filename}: {e!r}")
+        count_conversion_error(e)
+        finish_job(job_id, error=str(e) or type(e).__name__)
+        return f"Could not convert {file.filename}: {str(e) or type(e).__name__}", 422
+    finish_job(job_id)
+    output.seek(0)
+    download_name = file.filename.replace('.pdf', '_extracted.pdf')
+    return send_file(output, mimetype='application/pdf', download_name=download_name)
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """
+    Conversion metrics in the Prometheus text format, summed over every web worker:
+    the counters and the queue depth both come from the shared queue database.
+    """
+    lines = [
+        "# HELP pdfdata_stage_duration_seconds Time spent in each conversion stage.",
+        "# TYPE pdfdata_stage_duration_seconds histogram",
+    ]
+    buckets = read_counters("pdfdata_stage_duration_seconds_bucket")
+    sums = read_counters("pdfdata_stage_duration_seconds_sum")
+    for labels, count in sorted(read_counters("pdfdata_stage_duration_seconds_count").items()):
+        for bound in STAGE_DURATION_BUCKETS:
+            bucket_labels = f'{labels},le="{bound}"'
+            lines.append(f'pdfdata_stage_duration_seconds_bucket{{{bucket_labels}}} {buckets.get(bucket_labels, 0)}')
+        lines.append(f'pdfdata_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f'pdfdata_stage_duration_seconds_sum{{{labels}}} {sums[labels]}')
+        lines.append(f'pdfdata_stage_duration_seconds_count{{{labels}}} {count}')
+
+    conversion_errors = read_counters("pdfdata_conversion_errors_total")
+    lines.append("# HELP pdfdata_conversion_errors_total Failed conversions by reason.")
+    lines.append("# TYPE pdfdata_conversion_errors_total counter")
+    for reason in ("error", "timeout", "crash"):
+        labels = f'reason="{reason}"'
+        lines.append(f'pdfdata_conversion_errors_total{{{labels}}} {conversion_errors.get(labels, 0)}')
+
+    admission_rejections = read_counters("pdfdata_admission_rejections_total")
+    lines.append("# HELP pdfdata_admission_rejections_total Requests turned away, by the limit they went past.")
+    lines.append("# TYPE pdfdata_admission_rejections_total counter")
+    for limits in ADMISSION_LIMITS:
+        for limit in limits[:2]:
+            labels = f'limit="{limit}"'
+            lines.append(f'pdfdata_admission_rejections_total{{{labels}}} {admission_rejections.get(labels, 0)}')
+
+    hits = read_counters("pdfdata_result_cache_hits_total").get("", 0)
+    misses = read_counters("pdfdata_result_cache_misses_total").get("", 0)
+    lines += [
+        "# HELP pdfdata_result_cache_hits_total Uploads served from the result cache.",
+        "# TYPE pdfdata_result_cache_hits_total counter",
+        f"pdfdata_result_cache_hits_total {hits}",
+        "# HELP pdfdata_result_cache_misses_total Uploads that had to be converted.",
+        "# TYPE pdfdata_result_cache_misses_total counter",
+        f"pdfdata_result_cache_misses_total {misses}",
+    ]
+
+    with closing(get_jobs_db()) as db:
+        job_counts = dict(db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+    lines.append("# HELP pdfdata_queue_jobs Jobs in the conversion queue by status.")
+    lines.append("# TYPE pdfdata_queue_jobs gauge")
+    for status in ("queued", "running", "done", "failed"):
+        lines.append(f'pdfdata_queue_jobs{{status="{status}"}} {job_counts.get(status, 0)}')
+
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+@contextmanager
+def untimed(stage):
+    yield
+
+
+def untracked(stage):
+    pass
+
+
+# What generate_extracted_pdf reports to its progress callback, in order: the report's
+# layout was read and its template picked, the extractors finished, the output was built
+CONVERSION_STAGES = ("parsed", "extracted", "rendered")
+
+
+# Extractors run for every report: (stage name, extractor, report keys for its results)
+REPORT_EXTRACTORS = [
+    ("name_and_dob", extract_name_and_dob, ("extracted_data",)),
+    ("images", extract_images, ("images",)),
+    ("page_4", extract_data_from_page_4, ("page_4_data",)),
+    ("page_5", extract_data_from_page_5, ("page_5_table_1", "page_5_table_2")),
+    ("page_6", extract_data_from_page_6, ("page_6_data",)),
+    ("page_7", extract_data_from_page_7, ("page_7_table_1", "page_7_table_2")),
+    ("page_8", extract_data_from_page_8, ("page_8_table_1", "page_8_table_2")),
+    ("page_9", extract_data_from_page_9, ("page_9_data",)),
+]
+
+
+def extract_report(doc, timer=untimed, include_images=True):
+    """
+    Run every extractor over an open document and collect what render_report draws.
+    timer(stage) is entered around each extractor so callers can measure the stages;
+    include_images=False skips extract_images for callers that only need the metrics.
+    The pages each extractor reads under the report's template are released as soon as
+    it finishes to keep peak memory flat.
+    """
+    report = {"images": {}}
+    for stage, func, keys in REPORT_EXTRACTORS:
+        if func is extract_images and not include_images:
+            continue
+        with timer(stage):
+            result = func(doc)
+        doc.release(*doc.template.pages_for(func.names))
+        if len(keys) == 1:
+            result = (result,)
+        report.update(zip(keys, result))
+    return report
+
+
+# Report keys of the metric tables, in the order their metrics are listed
+METRIC_TABLE_KEYS = ("page_4_data", "page_6_data", "page_7_table_1", "page_7_table_2",
+                     "page_8_table_1", "page_8_table_2", "page_9_data")
+
+
+def report_metrics(report):
+    """The name/DOB and the metric tables of an extracted report as ReportMetrics."""
+    extracted_data = report["extracted_data"]
+    return ReportMetrics(extracted_data["name"], extracted_data["dob"],
+                         (metric for key in METRIC_TABLE_KEYS for metric in report[key]))
+
+
+def extract_metrics(source, engine=None):
+    """Run the extractors over one report without rendering anything and return its ReportMetrics."""
+    with open_document(source, engine) as doc:
+        return report_metrics(extract_report(doc, include_images=False))
+
+
+def generate_extracted_pdf(source, output, engine=None, timer=untimed, progress=untracked, disk=True):
+    """
+    Build the summary report for one upload and return its metrics.
+    source is a path or the PDF bytes and output a path or a writable buffer;
+    engine names one of EXTRACTION_ENGINES (default: the EXTRACTION_ENGINE setting).
+    progress(stage) is called as each of CONVERSION_STAGES completes. Without disk,
+    the image and OCR caches are only used in memory.
+    """
+    # Extract data and images for the specific file, parsing the upload only once
+    with open_document(source, engine, disk) as doc:
+        # Documents open lazily: reading the fingerprint page is what first parses the upload,
+        # so one that is not a PDF fails here rather than after reporting "parsed"
+        with timer("parse"):
+            doc.words(doc.template.fingerprint_page)
+        progress("parsed")
+        report = extract_report(doc, timer)
+    progress("extracted")
+    with timer("render"):
+        render_report(report, output)
+    progress("rendered")
+    return report_metrics(report)
+
+
+# Write image and page streams as binary; ASCII85 only makes them a quarter larger
+rl_config.useA85 = 0
+
+# Output layout, built once: page geometry, paragraph and table styles shared by every report
+REPORT_PAGE = {"pagesize": letter, "leftMargin": 75, "rightMargin": 62, "topMargin": 36, "bottomMargin": 50,
+               "title": "Brain Health EEG Report"}
+REPORT_STYLES = {
+    "title": ParagraphStyle("ReportTitle", fontName="Helvetica-Bold", fontSize=14, leading=20,
+                            alignment=TA_CENTER, spaceAfter=4),
+    "field": ParagraphStyle("ReportField", fontName="Helvetica", fontSize=12, leading=20),
+    "section": ParagraphStyle("ReportSection", fontName="Helvetica-Bold", fontSize=12, leading=14,
+                              spaceBefore=6, spaceAfter=6, keepWithNext=True),
+}
+METRIC_TABLE_STYLE = TableStyle([
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black),
+])
+HEADER_TABLE_STYLE = TableStyle([('BACKGROUND', (0, 0), (-1, 0), colors.grey)], parent=METRIC_TABLE_STYLE)
+SIDE_BY_SIDE_STYLE = TableStyle([
+    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ('LEFTPADDING', (0, 0), (-1, -1), 0),
+    ('RIGHTPADDING', (0, 0), (-1, -1), 0),
+])
+
+# Row labels and header drawn around page_5_table_2
+EEG_CHANGES_LABELS = [["OE1/CE.", "Left"], ["OE1/CE", "Right"], ["OE2/CE", "Left"], ["OE2/CE", "Right"],
+                      ["OE2/CE", "Right"]]
+EEG_CHANGES_HEADER = ["Div.", "Side", "δ", "θ", "α", "SMR", "-β", "+β"]
+
+
+def grid_table(rows, col_widths=None):
+    """A grid table of the rows (no column titles); long tables split across pages."""
+    table = Table([list(row) for row in rows], colWidths=col_widths, hAlign="LEFT")
+    table.setStyle(METRIC_TABLE_STYLE)
+    return table
+
+
+def table_section(rows):
+    if not rows:
+        return []
+    return [grid_table(rows)]
+
+
+def image_flowable(image, **kwargs):
+    return Image(io.BytesIO(image.data), width=image.width, height=image.height, **kwargs)
+
+
+def image_section(image):
+    if not image:
+        return []
+    return [image_flowable(image, hAlign="LEFT")]
+
+
+def eeg_changes_section(table):
+    """page_5_table_2 with its row labels and a header row repeated on every page it spans."""
+    rows = [EEG_CHANGES_HEADER]
+    for i, row in enumerate(table):
+        rows.append((EEG_CHANGES_LABELS[i] if i < len(EEG_CHANGES_LABELS) else ["", ""]) + row)
+    table = Table(rows, repeatRows=1, hAlign="LEFT")
+    table.setStyle(HEADER_TABLE_STYLE)
+    return [table]
+
+
+def image_with_table_section(image, rows):
+    """The image on the left and the rows' table on its right."""
+    left = image_flowable(image) if image else ""
+    layout = Table([[left, grid_table(rows, col_widths=[100, 100])]], colWidths=[250, 200], hAlign="LEFT")
+    layout.setStyle(SIDE_BY_SIDE_STYLE)
+    return [layout]
+
+
+# (section title, flowable builder, the report keys or images it draws)
+REPORT_SECTIONS = [
+    ("1. Frequency Appearance Rate and Average Amplitude", table_section, ("page_4_data",)),
+    ("2. The Change in Power of Alpha Waves", image_section, ("imagefrompage5",)),
+    ("3. Changes in EEG During Opening and Closing", eeg_changes_section, ("page_5_table_2",)),
+    ("4. Brain arousal level (0/SMR)", image_section, ("imagefrompage6",)),
+    ("5. Physical Tension and Stress", table_section, ("page_6_data",)),
+    ("6. Mental Distraction and Stress", table_section, ("page_7_table_1",)),
+    ("7. Behavioral Propensity (a/-B)", table_section, ("page_7_table_2",)),
+    ("8. Emotional Propensity (La- Ra)", table_section, ("page_8_table_1",)),
+    ("9. Balance Between Left and Right Brain", table_section, ("page_8_table_2",)),
+    ("10. Self-feedback Ability", image_with_table_section, ("imagefrompage9", "page_9_data")),
+]
+
+
+def section_divider():
+    return HRFlowable(width="100%", thickness=0.5, color=colors.black, spaceBefore=6, spaceAfter=9)
+
+
+def render_report(report, output):
+    """Bind the extracted report to REPORT_SECTIONS and build it onto letter pages saved to output."""
+    extracted_data = report["extracted_data"]
+    values = {**report, **report["images"]}
+
+    story = [
+        Paragraph(REPORT_PAGE["title"], REPORT_STYLES["title"]),
+        Paragraph(f"Name: {escape(str(extracted_data['name']))}", REPORT_STYLES["field"]),
+        Paragraph(f"DOB: {escape(str(extracted_data['dob']))}", REPORT_STYLES["field"]),
+        Spacer(1, 14),
+    ]
+    for number, (title, build_section, keys) in enumerate(REPORT_SECTIONS, start=1):
+        story.append(Paragraph(title, REPORT_STYLES["section"]))
+        story.extend(build_section(*(values.get(key) for key in keys)))
+        if number < len(REPORT_SECTIONS):
+            story.append(section_divider())
+
+    SimpleDocTemplate(output, **REPORT_PAGE).build(story)
+
+
+def warm_up():
+    """
+    Do the one-off work a process otherwise pays on its first request: load the metrics
+    of the report fonts, compile the page template, and build a small report and read it
+    back with every extraction engine. The gunicorn master calls this after preloading
+    the app (see gunicorn.conf.py), so every forked worker starts with it done.
+    """
+    for style in REPORT_STYLES.values():
+        pdfmetrics.getFont(style.fontName)
+    app.jinja_env.get_template('index.html')
+    sample = io.BytesIO()
+    SimpleDocTemplate(sample, **REPORT_PAGE).build([
+        Paragraph(REPORT_PAGE["title"], REPORT_STYLES["title"]),
+        grid_table([Metric("Dominant Frequency", "9.8Hz")]),
+    ])
+    for engine in EXTRACTION_ENGINES:
+        with open_document(sample.getvalue(), engine) as doc:
+            doc.words(1)
+            doc.tables(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,330 @@
+"""
+Benchmark for the extraction and report-generation pipeline.
+
+Builds synthetic EEG reports in the page layout the extractors expect and measures
+per-stage latency (each extractor, extract_images and the ReportLab rendering),
+throughput and peak RSS for a single report, a sequential batch and a batch spread
+over concurrent worker processes. With --startup it instead compares how long a web
+worker takes to serve its first request when it starts cold and when it is forked
+from a master that preloaded the app, as gunicorn.conf.py does. Results are printed
+and saved as JSON so runs can be compared to catch regressions.
+
+    python benchmark.py --reports 20 --iterations 10 --workers 4 --output bench_results.json
+    python benchmark.py --startup
+"""
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image as PILImage, ImageDraw
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+from reportlab.platypus import Table, TableStyle
+
+import app as app_module
+from app import EXTRACTION_ENGINES, timed_conversion
+
+# Run in a fresh interpreter: seconds spent importing the app, then serving the first request
+COLD_START_PROBE = """
+import time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.app.test_client().get("/")
+print(imported - started, time.perf_counter() - imported)
+"""
+
+
+def make_chart_png(seed):
+    """A random line chart standing in for the EEG graphs embedded on pages 5, 6 and 9."""
+    rng = random.Random(seed)
+    image = PILImage.new("RGB", (800, 400), "white")
+    draw = ImageDraw.Draw(image)
+    points = [(x, 200 + rng.randint(-150, 150)) for x in range(0, 800, 10)]
+    draw.line(points, fill=(rng.randint(0, 200), 0, 200), width=3)
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    buffer.seek(0)
+    return ImageReader(buffer)
+
+
+def draw_grid_table(pdf, rows, x, y):
+    """Draw a ruled table (pdfplumber and fitz only detect tables with lines) and return the next y."""
+    table = Table(rows)
+    table.setStyle(TableStyle([('GRID', (0, 0), (-1, -1), 1, colors.black)]))
+    _, height = table.wrap(500, y)
+    table.drawOn(pdf, x, y - height)
+    return y - height - 40
+
+
+def make_synthetic_report(seed=0, pages=9):
+    """Return the bytes of a report with the layout extract_data_from_page_4.._9 expect."""
+    rng = random.Random(seed)
+
+    def value():
+        return f"{rng.uniform(1, 99):.1f}"
+
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=letter)
+
+    pdf.setFont("Helvetica", 11)
+    pdf.drawString(72, 720, f"NAME: Patient {seed}")
+    pdf.drawString(72, 700, "D.O.B.: 1980/01/01")
+    pdf.showPage()
+
+    for _ in (2, 3):
+        pdf.setFont("Helvetica", 11)
+        pdf.drawString(72, 720, "Overview section")
+        pdf.showPage()
+
+    # Page 4: dominant and standard frequencies
+    pdf.setFont("Helvetica", 11)
+    pdf.drawString(72, 720, f"Dominant frequency {value()}Hz")
+    pdf.drawString(72, 700, f"Standard frequency {value()}Hz")
+    pdf.showPage()
+
+    # Page 5: alpha power chart, two rows of table 1 and four rows of table 2
+    pdf.setFont("Helvetica", 11)
+    pdf.drawString(72, 740, "Alpha power change")
+    pdf.drawImage(make_chart_png(seed), 72, 500, 400, 200)
+    y = 470
+    for row in range(6):
+        pdf.drawString(72, y, " ".join(value() for _ in range(5 if row < 2 else 6)))
+        y -= 18
+    pdf.showPage()
+
+    # Page 6: arousal chart and physical tension
+    pdf.setFont("Helvetica", 11)
+    pdf.drawImage(make_chart_png(seed + 1), 72, 500, 400, 200)
+    pdf.drawString(72, 470, f"Left {value()}")
+    pdf.drawString(72, 450, f"Right {value()}")
+    pdf.showPage()
+
+    # Page 7: three ruled tables, distraction in the second and A/-B in the third
+    y = 720
+    y = draw_grid_table(pdf, [["Item", "Left", "Right"], ["Base", "n", "n"]], 72, y)
+    y = draw_grid_table(pdf, [["Distraction", "Left", "Right"], ["value", value(), value()]], 72, y)
+    draw_grid_table(pdf, [["A/-B", "Left", "Right"], ["value", value(), value()]], 72, y)
+    pdf.showPage()
+
+    # Page 8: eight numbers read by position
+    pdf.setFont("Helvetica", 11)
+    pdf.drawString(72, 720, f"Left {value()} {value()} {value()} {value()}")
+    pdf.drawString(72, 700, f"Right {value()} {value()} {value()}% {value()}%")
+    pdf.showPage()
+
+    # Page 9: self-feedback chart and statistics table
+    pdf.drawImage(make_chart_png(seed + 2), 72, 500, 400, 200)
+    draw_grid_table(pdf, [["Sum", "Average", "Max Dev", "Std Dev"], [value(), value(), value(), value()]], 72, 470)
+    pdf.showPage()
+
+    for page in range(10, pages + 1):
+        pdf.setFont("Helvetica", 11)
+        pdf.drawString(72, 720, f"Appendix page {page}")
+        pdf.showPage()
+
+    pdf.save()
+    return buffer.getvalue()
+
+
+def summarize(samples):
+    """Latency percentiles in milliseconds."""
+    ordered = sorted(samples)
+
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": percentile(0.50),
+        "p90_ms": percentile(0.90),
+        "p99_ms": percentile(0.99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def convert_timed(report_bytes, engine):
+    """Convert one report in memory and return the duration of every stage plus the total."""
+    _, timings = timed_conversion(report_bytes, io.BytesIO(), engine)
+    return timings
+
+
+def scenario_result(all_timings, elapsed, peak_rss):
+    stages = defaultdict(list)
+    for timings in all_timings:
+        for stage, duration in timings.items():
+            stages[stage].append(duration)
+    return {
+        "reports": len(all_timings),
+        "elapsed_s": elapsed,
+        "reports_per_s": len(all_timings) / elapsed if elapsed else 0.0,
+        "peak_rss_mb": peak_rss,
+        "stages": {stage: summarize(samples) for stage, samples in stages.items()},
+    }
+
+
+def bench_single(report_bytes, iterations, engine):
+    convert_timed(report_bytes, engine)  # warm up imports and font caches
+    started = time.perf_counter()
+    all_timings = [convert_timed(report_bytes, engine) for _ in range(iterations)]
+    return scenario_result(all_timings, time.perf_counter() - started, peak_rss_mb())
+
+
+def bench_batch(reports, engine):
+    started = time.perf_counter()
+    all_timings = [convert_timed(report_bytes, engine) for report_bytes in reports]
+    return scenario_result(all_timings, time.perf_counter() - started, peak_rss_mb())
+
+
+def bench_concurrent(reports, workers, engine):
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Start every worker before timing so process start-up is not counted
+        list(pool.map(time.sleep, [0.1] * workers))
+        started = time.perf_counter()
+        all_timings = list(pool.map(convert_timed, reports, [engine] * len(reports)))
+        elapsed = time.perf_counter() - started
+    result = scenario_result(all_timings, elapsed, peak_rss_mb(resource.RUSAGE_CHILDREN))
+    result["workers"] = workers
+    return result
+
+
+def slowest_imports(count=8):
+    """The app's direct imports that take longest, by cumulative milliseconds (python -X importtime)."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                            capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Direct imports of app are indented by exactly two spaces after the separator's one
+        name = name[1:]
+        if name.startswith("   ") or not name.startswith("  "):
+            continue
+        imports.append((name.strip(), int(cumulative) / 1000))
+    return dict(sorted(imports, key=lambda item: item[1], reverse=True)[:count])
+
+
+def bench_startup(runs):
+    """
+    First-request latency of a web worker started cold (a new interpreter importing the
+    app) against one forked from this process after warm_up, as gunicorn's preload_app does.
+    """
+    with tempfile.TemporaryDirectory() as scratch:
+        # No conversion threads and a throwaway queue, so the probes never touch real jobs
+        env = dict(os.environ, CONVERSION_WORKERS="0", JOBS_DATABASE=os.path.join(scratch, "jobs.sqlite3"))
+        cold = []
+        for _ in range(runs):
+            result = subprocess.run([sys.executable, "-c", COLD_START_PROBE], env=env, capture_output=True,
+                                    text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            cold.append([float(seconds) for seconds in result.stdout.split()[-2:]])
+
+        app_module.app.config['CONVERSION_WORKERS'] = 0
+        app_module.app.config['JOBS_DATABASE'] = env["JOBS_DATABASE"]
+        app_module.warm_up()
+        gc.freeze()
+        forked = []
+        for _ in range(runs):
+            read_fd, write_fd = os.pipe()
+            started = time.perf_counter()
+            pid = os.fork()
+            if pid == 0:
+                app_module.app.test_client().get("/")
+                os.write(write_fd, b"1")
+                os._exit(0)
+            os.read(read_fd, 1)
+            forked.append(time.perf_counter() - started)
+            os.waitpid(pid, 0)
+            os.close(read_fd)
+            os.close(write_fd)
+        gc.unfreeze()
+
+    return {
+        "runs": runs,
+        "cold_import_ms": statistics.median(imported for imported, _ in cold) * 1000,
+        "cold_first_request_ms": statistics.median(first for _, first in cold) * 1000,
+        "cold_total_ms": statistics.median(sum(sample) for sample in cold) * 1000,
+        "preloaded_fork_to_first_response_ms": statistics.median(forked) * 1000,
+        "slowest_imports_ms": slowest_imports(),
+    }
+
+
+def print_startup(result):
+    print(f"\nstartup ({result['runs']} runs, medians): cold worker {result['cold_total_ms']:.0f} ms "
+          f"(import {result['cold_import_ms']:.0f} ms + first request {result['cold_first_request_ms']:.0f} ms), "
+          f"worker forked from a preloaded master {result['preloaded_fork_to_first_response_ms']:.0f} ms")
+    print("  slowest imports: " + ", ".join(f"{name} {ms:.0f} ms" for name, ms in result["slowest_imports_ms"].items()))
+
+
+def print_scenario(name, result):
+    print(f"\n{name}: {result['reports']} reports in {result['elapsed_s']:.2f}s "
+          f"({result['reports_per_s']:.2f} reports/s, peak RSS {result['peak_rss_mb']:.1f} MB)")
+    print(f"  {'stage':<14}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}  (ms)")
+    for stage, stats in result["stages"].items():
+        print(f"  {stage:<14}{stats['mean_ms']:>10.1f}{stats['p50_ms']:>10.1f}"
+              f"{stats['p90_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--reports", type=int, default=20, help="reports in the batch scenarios")
+    parser.add_argument("--iterations", type=int, default=10, help="repetitions of the single-report scenario")
+    parser.add_argument("--workers", type=int, default=4, help="processes in the concurrent scenario")
+    parser.add_argument("--pages", type=int, default=9, help="pages per synthetic report (9 or more)")
+    parser.add_argument("--engine", choices=sorted(EXTRACTION_ENGINES), default="pdfplumber")
+    parser.add_argument("--output", default="bench_results.json", help="where to save the JSON results")
+    parser.add_argument("--startup", action="store_true",
+                        help="compare cold and preloaded worker start-up instead of running the conversion scenarios")
+    args = parser.parse_args()
+
+    results = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "engine": args.engine,
+        "pages": max(args.pages, 9),
+        "scenarios": {},
+    }
+    if args.startup:
+        # --iterations is the number of workers started each way
+        results["startup"] = bench_startup(args.iterations)
+        print_startup(results["startup"])
+    else:
+        reports = [make_synthetic_report(seed, max(args.pages, 9)) for seed in range(args.reports)]
+        scenarios = [
+            ("single", lambda: bench_single(reports[0], args.iterations, args.engine)),
+            ("batch", lambda: bench_batch(reports, args.engine)),
+            ("concurrent", lambda: bench_concurrent(reports, args.workers, args.engine)),
+        ]
+        for name, run in scenarios:
+            results["scenarios"][name] = run()
+            print_scenario(name, results["scenarios"][name])
+
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"\nResults saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Calibrate the crop boxes of an extraction template from a sample report.
+
+For every rule of the template, finds where the tokens it picks sit on the sample
+(the words it picks, or the table it reads) and records that region, padded,
+as the rule's bbox, so extraction only looks at the metric regions and unrelated
+numbers such as footers and dates cannot shift the picks. A box is only kept when
+every extraction engine reads the same values from it as from the whole page.
+
+    python calibrate_template.py sample.pdf > calibrated.json
+    python calibrate_template.py sample.pdf --template vendor_b --output extraction_templates/vendor_b.json
+"""
+import argparse
+import copy
+import json
+import math
+import sys
+
+import numpy as np
+
+from app import (EXTRACTION_ENGINES, EXTRACTION_TEMPLATES, TemplateError, TemplateRule, app,
+                 open_document, parse_template)
+
+
+def padded_bbox(boxes, padding, page_bbox):
+    """Union of boxes grown by padding, rounded outwards to whole points and kept on the page."""
+    x0, top, x1, bottom = page_bbox
+    return [
+        max(x0, math.floor(min(box[0] for box in boxes) - padding)),
+        max(top, math.floor(min(box[1] for box in boxes) - padding)),
+        min(x1, math.ceil(max(box[2] for box in boxes) + padding)),
+        min(bottom, math.ceil(max(box[3] for box in boxes) + padding)),
+    ]
+
+
+def picked_boxes(doc, rule, table_section):
+    """
+    Boxes of the words the rule picks (or of the lines it returns as rows), and how
+    many tokens (or rows) the rule reads before the first of them.
+    """
+    if table_section:
+        tokens = rule.token_stream(doc)
+        lines = list(tokens.lines())
+        words = tokens[np.isin(tokens.line, lines[rule.rows])]
+        skipped = range(len(lines))[rule.rows].start
+    else:
+        picked = rule.picked(doc)
+        positions = sorted(index for index in set(rule.fields.values()) if index < len(picked))
+        words = picked[np.array(positions, dtype=int)]
+        skipped = positions[0] if positions else 0
+    return list(zip(words.x0.tolist(), words.top.tolist(), words.x1.tolist(), words.bottom.tolist())), skipped
+
+
+def extracted(rule, doc, table_section):
+    """What the rule contributes to a report: its table rows, or its fields' values."""
+    if table_section:
+        return rule.table_rows(doc)
+    tokens = rule.tokens(doc)
+    if tokens is None:
+        return None
+    return {name: tokens[index] if index < len(tokens) else None for name, index in rule.fields.items()}
+
+
+def calibrate_rule(rule_spec, token_patterns, docs, padding, table_section):
+    """Return (calibrated rule spec or None, message)."""
+    if rule_spec.get("bbox"):
+        return None, "already has a bbox"
+    rule = TemplateRule(rule_spec, token_patterns)
+    reference = docs["pdfplumber"]
+    try:
+        page = reference.page(rule.page)
+    except IndexError:
+        return None, "page not in the sample"
+    if extracted(rule, reference, table_section) in (None, []):
+        return None, "nothing found on the sample"
+
+    calibrated = copy.deepcopy(rule_spec)
+    if rule.source == "table":
+        tables = page.find_tables()
+        if len(tables) <= rule.table:
+            return None, "table not found on the sample"
+        boxes = [tables[rule.table].bbox]
+        # The cropped region holds only this table
+        calibrated["table"] = 0
+    else:
+        boxes, skipped = picked_boxes(reference, rule, table_section)
+        if not boxes:
+            return None, "no tokens picked on the sample"
+        # Positions count from the start of the cropped region, which leaves out what came before
+        if table_section:
+            start, stop = rule.rows.start, rule.rows.stop
+            calibrated["rows"] = [0, None if stop is None else stop - (start or 0)]
+        else:
+            calibrated["fields"] = {name: index - skipped for name, index in rule.fields.items()}
+            calibrated["min_count"] = rule.min_count - skipped
+    calibrated["bbox"] = padded_bbox(boxes, padding, page.bbox)
+
+    cropped = TemplateRule(calibrated, token_patterns)
+    for engine, doc in docs.items():
+        if extracted(cropped, doc, table_section) != extracted(rule, doc, table_section):
+            return None, f"cropped region reads differently with {engine}"
+    return calibrated, f"bbox {calibrated['bbox']}"
+
+
+def calibrate_template(spec, sample, padding):
+    """Return a copy of the template spec with calibrated bboxes, printing what happened to each rule."""
+    spec = copy.deepcopy(spec)
+    token_patterns = spec.get("tokens", {})
+    docs = {engine: open_document(sample, engine) for engine in EXTRACTION_ENGINES}
+    try:
+        for index, rule_spec in enumerate(spec.get("fields", [])):
+            label = f"page {rule_spec['page']} fields {', '.join(rule_spec.get('fields', {}))}"
+            calibrated, message = calibrate_rule(rule_spec, token_patterns, docs, padding, False)
+            if calibrated is not None:
+                spec["fields"][index] = calibrated
+            print(f"{label}: {message}", file=sys.stderr)
+        for name, rule_specs in spec.get("tables", {}).items():
+            for index, rule_spec in enumerate(rule_specs):
+                label = f"page {rule_spec['page']} table {name} (rule {index + 1})"
+                calibrated, message = calibrate_rule(rule_spec, token_patterns, docs, padding, True)
+                if calibrated is not None:
+                    rule_specs[index] = calibrated
+                print(f"{label}: {message}", file=sys.stderr)
+    finally:
+        for doc in docs.values():
+            doc.close()
+    return spec
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("sample", help="a report in the template's layout")
+    parser.add_argument("--template", default=app.config['DEFAULT_EXTRACTION_TEMPLATE'],
+                        help="name of the template to calibrate (default: %(default)s)")
+    parser.add_argument("--padding", type=float, default=3, help="points added around each region")
+    parser.add_argument("--output", help="where to write the calibrated template (default: stdout)")
+    args = parser.parse_args()
+
+    template = next((t for t in EXTRACTION_TEMPLATES if t.name == args.template), None)
+    if template is None:
+        parser.error(f"no extraction template named {args.template!r}")
+    with open(template.path, "rb") as template_file:
+        try:
+            spec = parse_template(template_file.read(), template.path)
+        except TemplateError as e:
+            sys.exit(f"{template.path}: {e}")
+
+    calibrated = json.dumps(calibrate_template(spec, args.sample, args.padding), indent=2) + "\n"
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(calibrated)
+    else:
+        sys.stdout.write(calibrated)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Bulk export of extracted report metrics for population analysis.
+
+Runs the extractors (no PDF rendering) over every report in a directory and writes
+one row per report with typed numeric columns to CSV, Parquet or a SQLite table.
+Rows are written as reports finish, so memory use does not grow with the backfill.
+
+    python export_metrics.py reports/ metrics.csv
+    python export_metrics.py reports/ metrics.parquet --workers 8
+    python export_metrics.py reports/ metrics.sqlite3 --table report_metrics
+"""
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from app import EXTRACTION_ENGINES, Missing, extract_metrics
+
+# (column, metric name from report_metrics, type); real columns take the number without its unit (Hz, %)
+COLUMNS = [
+    ("name", "Name", "text"),
+    ("dob", "DOB", "text"),
+    ("standard_frequency_hz", "Standard Frequency", "real"),
+    ("dominant_frequency_hz", "Dominant Frequency", "real"),
+    ("p_tension_left", "P. Tension Left", "real"),
+    ("p_tension_right", "P. Tension Right", "real"),
+    ("distraction_left", "Distraction Left", "real"),
+    ("distraction_right", "Distraction Right", "real"),
+    ("a_minus_b_left", "A/-B Left", "real"),
+    ("a_minus_b_right", "A/-B Right", "real"),
+    ("avg_a_left", "Avg. A (Left)", "real"),
+    ("avg_a_right", "Avg. A (Right)", "real"),
+    ("plus_b_left", "+B (Left)", "real"),
+    ("plus_b_right", "+B (Right)", "real"),
+    ("diff_ratio_la_ra", "Diff. Ratio La - Ra", "real"),
+    ("diff_ratio_plus_b_ce", "Diff. Ratio +B (CE)", "real"),
+    ("amp_symmetry_pct", "Amp. Symmetry", "real"),
+    ("l_r_sympathy_pct", "L-R Sympathy", "real"),
+    ("sum", "Sum", "real"),
+    ("average", "Average", "real"),
+    ("max_dev", "Max Dev", "real"),
+    ("std_dev", "Std Dev", "real"),
+]
+ROW_COLUMNS = [("source", "text"), ("error", "text")] + [(column, kind) for column, _, kind in COLUMNS]
+
+
+def extract_row(path, engine):
+    """One output row for a report; extraction errors are recorded instead of aborting the export."""
+    row = {"source": path, "error": None}
+    try:
+        metrics = extract_metrics(path, engine)
+    except Exception as e:
+        row["error"] = str(e) or type(e).__name__
+        metrics = None
+    for column, metric, kind in COLUMNS:
+        if metrics is None:
+            value = None
+        elif metric == "Name":
+            value = metrics.name
+        elif metric == "DOB":
+            value = metrics.dob
+        else:
+            found = metrics.get(metric)
+            value = None if found is None else found.number if kind == "real" else found.value
+        # Missing values are stored as NULL rather than as their "Not Found" text
+        row[column] = None if isinstance(value, Missing) else value
+    return row
+
+
+class CsvWriter:
+    def __init__(self, path, table):
+        self._file = open(path, "w", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=[column for column, _ in ROW_COLUMNS])
+        self._writer.writeheader()
+
+    def write(self, row):
+        self._writer.writerow(row)
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    """Buffers rows into row groups so a large export never holds more than one group in memory."""
+
+    row_group_size = 1000
+
+    def __init__(self, path, table):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            sys.exit("Parquet output needs pyarrow (pip install pyarrow)")
+        self._pa = pa
+        self._schema = pa.schema([
+            (column, pa.float64() if kind == "real" else pa.string()) for column, kind in ROW_COLUMNS
+        ])
+        self._writer = pq.ParquetWriter(path, self._schema)
+        self._rows = []
+
+    def write(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if self._rows:
+            self._writer.write_table(self._pa.Table.from_pylist(self._rows, schema=self._schema))
+            self._rows = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+class SqliteWriter:
+    """Appends to a typed table, committing every few hundred rows."""
+
+    commit_every = 500
+
+    def __init__(self, path, table):
+        self._db = sqlite3.connect(path)
+        columns = ", ".join(f'"{column}" {kind.upper()}' for column, kind in ROW_COLUMNS)
+        self._db.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({columns})')
+        placeholders = ", ".join("?" for _ in ROW_COLUMNS)
+        self._insert = f'INSERT INTO "{table}" VALUES ({placeholders})'
+        self._pending = 0
+
+    def write(self, row):
+        self._db.execute(self._insert, [row[column] for column, _ in ROW_COLUMNS])
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self._db.commit()
+            self._pending = 0
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
+WRITERS = {".csv": CsvWriter, ".parquet": ParquetWriter, ".sqlite": SqliteWriter,
+           ".sqlite3": SqliteWriter, ".db": SqliteWriter}
+
+
+def find_reports(directory):
+    for root, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            if filename.lower().endswith(".pdf"):
+                yield os.path.join(root, filename)
+
+
+def export_reports(paths, writer, workers=1, engine=None):
+    """Extract every report and hand each row to writer as soon as it is ready. Returns (rows, errors)."""
+    rows = errors = 0
+    if workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        results = pool.map(extract_row, paths, [engine] * len(paths), chunksize=8)
+    else:
+        pool = None
+        results = (extract_row(path, engine) for path in paths)
+    try:
+        for row in results:
+            writer.write(row)
+            rows += 1
+            errors += row["error"] is not None
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    return rows, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("directory", help="directory searched recursively for .pdf reports")
+    parser.add_argument("output", help="output file: .csv, .parquet, or .sqlite/.sqlite3/.db")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="parallel extraction processes")
+    parser.add_argument("--engine", choices=sorted(EXTRACTION_ENGINES), default=None,
+                        help="extraction engine (default: the EXTRACTION_ENGINE setting)")
+    parser.add_argument("--table", default="report_metrics", help="table to append to for SQLite output")
+    args = parser.parse_args()
+
+    writer_class = WRITERS.get(os.path.splitext(args.output)[1].lower())
+    if writer_class is None:
+        parser.error(f"unsupported output type: {args.output}")
+
+    paths = list(find_reports(args.directory))
+    started = time.perf_counter()
+    writer = writer_class(args.output, args.table)
+    try:
+        rows, errors = export_reports(paths, writer, args.workers, args.engine)
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - started
+    print(f"Exported {rows} reports ({errors} failed) to {args.output} in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+"""
+Gunicorn settings, read by the Procfile's gunicorn -c gunicorn.conf.py app:app.
+
+The app is imported and warmed up once in the master (preload_app), so the heavy
+imports, font metrics and compiled templates and styles live in memory the forked
+workers share copy-on-write, and a worker booted on start-up or after a max_requests
+recycle is ready as soon as it is forked.
+"""
+import gc
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+# Threaded workers: a progress event stream or streamed ZIP stays open for a whole batch, which
+# would hold a sync worker for that long and outlast its timeout
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+preload_app = True
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
+
+
+def on_starting(server):
+    from app import warm_up
+
+    warm_up()
+    # Move everything loaded so far out of the collector's reach, so collections in the
+    # workers do not write to (and so copy) the pages they share with the master
+    gc.freeze()
@@ -0,0 +1,46 @@
+"""
+The app is imported with its job queue, uploads and caches in a scratch directory,
+and runs its conversion workers as it does under gunicorn.
+"""
+import io
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# UPLOAD_FOLDER and the queue database are relative to the working directory at import
+os.chdir(tempfile.mkdtemp(prefix="pdfdata-tests-"))
+os.environ["JOBS_DATABASE"] = "jobs.sqlite3"
+
+import app  # noqa: E402
+from benchmark import make_synthetic_report  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+@pytest.fixture
+def report_file():
+    """A synthetic report as a form file; every call builds new bytes, so it is never a cache hit."""
+    def make(seed, filename=None):
+        return io.BytesIO(make_synthetic_report(seed)), filename or f"report{seed}.pdf"
+    return make
+
+
+@pytest.fixture
+def finished_job(client):
+    """Poll a job until it is done or failed and return its final state."""
+    def wait(job, timeout=60):
+        deadline = time.monotonic() + timeout
+        while job["status"] not in ("done", "failed"):
+            assert time.monotonic() < deadline, f"{job['filename']} still {job['status']}"
+            time.sleep(0.1)
+            job = client.get(job["status_url"]).json
+        return job
+    return wait
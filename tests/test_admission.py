@@ -0,0 +1,94 @@
+import io
+
+import pytest
+
+import app
+from benchmark import make_synthetic_report
+
+
+@pytest.fixture
+def claim(monkeypatch, tmp_path):
+    """
+    An empty queue of its own that the conversion workers leave alone; returns
+    claim_next_job for the test to take jobs from it itself.
+    """
+    monkeypatch.setitem(app.app.config, 'JOBS_DATABASE', str(tmp_path / "jobs.sqlite3"))
+    claim_next_job = app.claim_next_job
+    monkeypatch.setattr(app, "claim_next_job", lambda: None)
+    return claim_next_job
+
+
+def post_batch(client, seeds, address="10.0.0.1"):
+    files = [(io.BytesIO(make_synthetic_report(seed)), f"{seed}.pdf") for seed in seeds]
+    return client.post("/", data={"pdf_files": files}, headers={"Accept": "application/json"},
+                       environ_base={"REMOTE_ADDR": address})
+
+
+def rejections(client):
+    lines = client.get("/metrics").get_data(as_text=True).splitlines()
+    return {line.split(" ")[0]: int(line.split(" ")[1]) for line in lines
+            if line.startswith("pdfdata_admission_rejections_total") and not line.endswith(" 0")}
+
+
+def test_request_over_a_limit_is_413(client, claim, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'MAX_REQUEST_FILES', 2)
+    response = post_batch(client, [60, 61, 62])
+    assert response.status_code == 413
+    assert rejections(client) == {'pdfdata_admission_rejections_total{limit="MAX_REQUEST_FILES"}': 1}
+
+
+def test_empty_queue_takes_a_request_over_the_in_flight_limits(client, claim, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'MAX_INFLIGHT_PAGES', 10)
+    assert post_batch(client, [63, 64]).status_code == 202
+
+
+@pytest.mark.parametrize("setting", ["MAX_INFLIGHT_JOBS", "MAX_INFLIGHT_PAGES"])
+def test_full_queue_is_429_with_retry_after(client, claim, monkeypatch, setting):
+    # Room for one report of 9 pages
+    monkeypatch.setitem(app.app.config, setting, 1 if setting == "MAX_INFLIGHT_JOBS" else 10)
+    assert post_batch(client, [65]).status_code == 202
+
+    responses = [
+        post_batch(client, [66], address="10.0.0.2"),
+        client.post("/convert", data={"pdf_file": (io.BytesIO(make_synthetic_report(67)), "report.pdf")}),
+    ]
+    if setting == "MAX_INFLIGHT_JOBS":
+        responses.append(client.post("/uploads", json={"filename": "report.pdf", "size": 10}))
+    for response in responses:
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) >= 1
+    assert rejections(client) == {f'pdfdata_admission_rejections_total{{limit="{setting}"}}': len(responses)}
+
+
+@pytest.mark.parametrize("setting, limit, status", [("MAX_REQUEST_PAGES", 5, 413), ("MAX_INFLIGHT_PAGES", 10, 429)])
+def test_completed_upload_over_a_page_limit_starts_over(client, claim, monkeypatch, setting, limit, status):
+    monkeypatch.setitem(app.app.config, setting, limit)
+    if status == 429:
+        assert post_batch(client, [68]).status_code == 202
+    data = make_synthetic_report(69)
+    upload = client.post("/uploads", json={"filename": "report.pdf", "size": len(data)}).json
+    response = client.patch(upload["upload_url"], data=data, headers={"Upload-Offset": "0"})
+    assert response.status_code == status
+    assert client.get(upload["upload_url"]).json["offset"] == 0
+    assert app.get_upload(upload["id"])["job_id"] is None
+    assert rejections(client) == {f'pdfdata_admission_rejections_total{{limit="{setting}"}}': 1}
+
+
+def test_clients_take_turns(client, claim):
+    post_batch(client, [70, 71, 72], address="10.0.0.1")
+    post_batch(client, [73, 74], address="10.0.0.2")
+    post_batch(client, [75], address="10.0.0.3")
+    order = []
+    while (job := claim()) is not None:
+        order.append((job["client"], job["filename"]))
+    assert order == [
+        ("10.0.0.1", "70.pdf"), ("10.0.0.2", "73.pdf"), ("10.0.0.3", "75.pdf"),
+        ("10.0.0.1", "71.pdf"), ("10.0.0.2", "74.pdf"), ("10.0.0.1", "72.pdf"),
+    ]
+
+
+def test_client_at_its_running_limit_waits(client, claim, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'MAX_CLIENT_RUNNING_JOBS', 1)
+    post_batch(client, [76, 77], address="10.0.0.1")
+    assert claim()["filename"] == "76.pdf"
+    assert claim() is None
@@ -0,0 +1,66 @@
+import io
+import json
+
+import app
+
+
+def parse_events(stream):
+    """(event, data) pairs of a text/event-stream; comments come back as (None, comment)."""
+    events = []
+    for block in stream.strip().split("\n\n"):
+        if block.startswith(":"):
+            events.append((None, block[1:].strip()))
+            continue
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+def test_events_follow_every_job_to_the_end(client, report_file):
+    files = [report_file(80), (io.BytesIO(b"not a pdf"), "bad.pdf")]
+    batch = client.post("/", data={"pdf_files": files}, headers={"Accept": "application/json"}).json
+
+    response = client.get(batch["events_url"])
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    assert response.headers["Cache-Control"] == "no-cache"
+    events = [(event, data) for event, data in parse_events(response.get_data(as_text=True)) if event]
+
+    assert events[-1] == ("end", {})
+    last = {data["filename"]: data for event, data in events[:-1]}
+    assert last["report80.pdf"]["status"] == "done"
+    assert last["report80.pdf"]["metrics"]["Name"] == "Patient 80"
+    assert last["bad.pdf"]["status"] == "failed"
+    # Each job is reported when first seen, then on every change, and never twice the same
+    states = [(data["id"], data["status"], data.get("stage")) for _, data in events[:-1]]
+    assert len(states) == len(set(states))
+    stages = [data["stage"] for _, data in events[:-1] if data["filename"] == "report80.pdf" and "stage" in data]
+    assert stages == sorted(stages, key=["parsed", "extracted", "rendered"].index)
+
+
+def test_invalid_pdf_is_never_parsed(client):
+    batch = client.post("/", data={"pdf_files": [(io.BytesIO(b"not a pdf"), "bad.pdf")]},
+                        headers={"Accept": "application/json"}).json
+    events = parse_events(client.get(batch["events_url"]).get_data(as_text=True))
+    assert all(data.get("stage") is None for event, data in events if event == "job")
+
+
+def test_events_end_past_the_deadline(client, report_file, monkeypatch, tmp_path):
+    # Nothing converts the batch, which stays queued
+    monkeypatch.setitem(app.app.config, 'JOBS_DATABASE', str(tmp_path / "jobs.sqlite3"))
+    monkeypatch.setattr(app, "claim_next_job", lambda: None)
+    monkeypatch.setitem(app.app.config, 'CONVERSION_TIMEOUT', 0.1)
+    batch = client.post("/", data={"pdf_files": [report_file(82)]}, headers={"Accept": "application/json"}).json
+
+    events = parse_events(client.get(batch["events_url"]).get_data(as_text=True))
+    assert [(event, data.get("status")) for event, data in events] == [("job", "queued"), ("end", None)]
+
+
+def test_batch_page_subscribes_to_its_events(client, report_file):
+    page = client.post("/", data={"pdf_files": [report_file(81)]}).get_data(as_text=True)
+    assert 'data-events-url="/batches/' in page
+    assert "data-job-id=" in page
+
+
+def test_events_of_unknown_batch_is_404(client):
+    assert client.get("/batches/nope/events").status_code == 404
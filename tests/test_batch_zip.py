@@ -0,0 +1,43 @@
+import csv
+import io
+import zipfile
+
+import app
+
+
+def test_zip_streams_every_report_and_the_metrics(client, report_file):
+    report, _ = report_file(30)
+    files = [(report, "a.pdf"), (io.BytesIO(b"not a pdf"), "bad.pdf"), report_file(31, "b.pdf"),
+             (io.BytesIO(report.getvalue()), "a.pdf")]
+    batch = client.post("/", data={"pdf_files": files}, headers={"Accept": "application/json"}).json
+
+    # The archive is only complete once every job has finished, so this also waits for the batch
+    response = client.get(f"/batches/{batch['batch_id']}/download.zip")
+    assert response.status_code == 200
+    assert response.headers["Content-Disposition"] == f"attachment; filename=extracted_{batch['batch_id']}.zip"
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+    assert sorted(archive.namelist()) == ["a_extracted (2).pdf", "a_extracted.pdf", "b_extracted.pdf", "metrics.csv"]
+    assert archive.read("b_extracted.pdf").startswith(b"%PDF")
+
+    rows = {row["filename"]: row for row in csv.DictReader(io.StringIO(archive.read("metrics.csv").decode()))}
+    assert rows["b.pdf"]["status"] == "done"
+    assert rows["b.pdf"]["Name"] == "Patient 31"
+    assert rows["bad.pdf"]["status"] == "failed"
+    assert rows["bad.pdf"]["error"]
+
+
+def test_zip_stops_waiting_for_jobs_past_the_deadline(client, report_file, monkeypatch, tmp_path):
+    # Nothing converts the batch, which stays queued
+    monkeypatch.setitem(app.app.config, 'JOBS_DATABASE', str(tmp_path / "jobs.sqlite3"))
+    monkeypatch.setattr(app, "claim_next_job", lambda: None)
+    monkeypatch.setitem(app.app.config, 'CONVERSION_TIMEOUT', 0.1)
+    batch = client.post("/", data={"pdf_files": [report_file(32)]}, headers={"Accept": "application/json"}).json
+
+    archive = zipfile.ZipFile(io.BytesIO(client.get(f"/batches/{batch['batch_id']}/download.zip").data))
+    assert archive.namelist() == ["metrics.csv"]
+    (row,) = csv.DictReader(io.StringIO(archive.read("metrics.csv").decode()))
+    assert (row["filename"], row["status"]) == ("report32.pdf", "queued")
+
+
+def test_zip_of_unknown_batch_is_404(client):
+    assert client.get("/batches/nope/download.zip").status_code == 404
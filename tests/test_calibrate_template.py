@@ -0,0 +1,34 @@
+import pytest
+
+import app
+from benchmark import make_synthetic_report
+from calibrate_template import calibrate_template
+
+
+@pytest.fixture(scope="module")
+def calibrated(tmp_path_factory):
+    sample = tmp_path_factory.mktemp("calibration") / "sample.pdf"
+    sample.write_bytes(make_synthetic_report(5))
+    template = next(t for t in app.EXTRACTION_TEMPLATES if t.name == app.app.config['DEFAULT_EXTRACTION_TEMPLATE'])
+    with open(template.path, "rb") as template_file:
+        spec = app.parse_template(template_file.read(), template.path)
+    return app.ExtractionTemplate(calibrate_template(spec, str(sample), 3))
+
+
+def extract(source, engine, template=None):
+    with app.open_document(source, engine) as doc:
+        if template is not None:
+            doc._template = template
+        report = app.extract_report(doc, include_images=False)
+        regions = [bbox for _, bbox in doc._words if bbox is not None]
+    return {key: [tuple(row) for row in value] if isinstance(value, list) else value
+            for key, value in report.items()}, regions
+
+
+@pytest.mark.parametrize("engine", ["pdfplumber", "fitz"])
+def test_calibrated_regions_read_the_same_report(calibrated, engine):
+    source = make_synthetic_report(6)
+    report, _ = extract(source, engine)
+    cropped, regions = extract(source, engine, calibrated)
+    assert regions
+    assert cropped == report
@@ -0,0 +1,113 @@
+import hashlib
+import threading
+from contextlib import closing
+
+import pytest
+
+import app
+from benchmark import make_synthetic_report
+
+CHUNK = 20000
+
+
+def checksum(data):
+    return f"sha256 {hashlib.sha256(data).hexdigest()}"
+
+
+def start_upload(client, data, filename="report.pdf", **fields):
+    response = client.post("/uploads", json={"filename": filename, "size": len(data),
+                                             "sha256": hashlib.sha256(data).hexdigest(), **fields})
+    assert response.status_code == 201
+    return response.json
+
+
+def test_upload_in_chunks_is_queued_when_complete(client, finished_job):
+    data = make_synthetic_report(50)
+    url = start_upload(client, data)["upload_url"]
+    offset = 0
+    while offset < len(data):
+        chunk = data[offset:offset + CHUNK]
+        response = client.patch(url, data=chunk,
+                                headers={"Upload-Offset": str(offset), "Upload-Checksum": checksum(chunk)})
+        assert response.status_code == 200
+        offset = response.json["offset"]
+
+    assert client.get(url).json["offset"] == len(data)
+    job = finished_job(client.get(url).json["job"])
+    assert job["metrics"]["Name"] == "Patient 50"
+    # Complete uploads take no more data
+    assert client.patch(url, data=b"x", headers={"Upload-Offset": str(offset)}).status_code == 409
+
+
+def test_chunk_is_rejected(client):
+    data = make_synthetic_report(51)
+    url = start_upload(client, data)["upload_url"]
+    assert client.patch(url, data=data[:10], headers={"Upload-Offset": "5"}).status_code == 409
+    bad_checksum = client.patch(url, data=data[:CHUNK],
+                                headers={"Upload-Offset": "0", "Upload-Checksum": checksum(b"")})
+    assert bad_checksum.status_code == 400
+    assert client.patch(url, data=data + b"x", headers={"Upload-Offset": "0"}).status_code == 400
+    assert client.get(url).json["offset"] == 0
+
+
+def test_upload_not_matching_its_sha256_starts_over(client):
+    upload = client.post("/uploads", json={"filename": "report.pdf", "size": 10, "sha256": "1" * 64}).json
+    response = client.patch(upload["upload_url"], data=b"0123456789", headers={"Upload-Offset": "0"})
+    assert response.status_code == 400
+    assert client.get(upload["upload_url"]).json["offset"] == 0
+    assert app.get_upload(upload["id"])["job_id"] is None
+
+
+def test_upload_completed_twice_at_once_is_queued_once(client):
+    data = make_synthetic_report(52)
+    upload = start_upload(client, data)
+    with open(app.upload_part_path(upload["id"]), "wb") as part:
+        part.write(data)
+    with closing(app.get_jobs_db()) as db:
+        db.execute("UPDATE uploads SET received = size WHERE id = ?", (upload["id"],))
+    stored = app.get_upload(upload["id"])
+
+    barrier = threading.Barrier(2)
+    errors = []
+
+    def complete():
+        barrier.wait()
+        try:
+            errors.append(app.complete_upload(stored))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=complete) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == [None, None]
+    jobs = app.get_batch_jobs(upload["batch_id"])
+    assert [job["id"] for job in jobs] == [app.get_upload(upload["id"])["job_id"]]
+
+
+def test_uploads_join_an_existing_batch(client):
+    first = start_upload(client, make_synthetic_report(53))
+    second = client.post("/uploads", json={"filename": "b.pdf", "size": 3, "batch_id": first["batch_id"]})
+    assert second.status_code == 201
+    assert second.json["batch_id"] == first["batch_id"]
+    assert client.post("/uploads", json={"filename": "c.pdf", "size": 3, "batch_id": "nope"}).status_code == 404
+    assert client.get("/uploads/nope").status_code == 404
+
+
+@pytest.mark.parametrize("fields", [
+    {"filename": 1, "size": 3},
+    {"filename": "a.pdf", "size": 3, "sha256": 5},
+    {"filename": "a.pdf", "size": 3, "engine": ["fitz"]},
+    {"filename": "a.pdf", "size": 3, "batch_id": ["x"]},
+])
+def test_upload_fields_must_be_strings(client, fields):
+    response = client.post("/uploads", json=fields)
+    assert response.status_code == 400
+    assert response.get_data(as_text=True).endswith("must be a string")
+
+
+def test_upload_needs_a_json_object(client):
+    assert client.post("/uploads", json=["a.pdf", 3]).status_code == 400
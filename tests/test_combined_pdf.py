@@ -0,0 +1,37 @@
+import io
+
+import fitz
+
+import app
+
+
+def test_combined_pdf_has_a_bookmark_per_patient(client, report_file, finished_job):
+    files = [report_file(40), (io.BytesIO(b"not a pdf"), "bad.pdf"), report_file(41)]
+    batch = client.post("/", data={"pdf_files": files}, headers={"Accept": "application/json"}).json
+    url = f"/batches/{batch['batch_id']}/combined.pdf"
+    jobs = [finished_job(job) for job in batch["jobs"]]
+
+    response = client.get(url)
+    assert response.status_code == 200
+    with fitz.open(stream=response.data, filetype="pdf") as combined:
+        toc = combined.get_toc()
+        page_count = combined.page_count
+    assert [title for _, title, _ in toc] == ["Patient 40", "Patient 41"]
+    assert toc[0][2] == 1
+    assert page_count == 2 * (toc[1][2] - 1)
+    # Built once, then served from the result cache
+    assert client.get(url).data == response.data
+    assert [job["status"] for job in jobs] == ["done", "failed", "done"]
+
+
+def test_combined_pdf_waits_for_the_batch(client, report_file, monkeypatch):
+    # Conversion workers that claim nothing leave the job queued
+    monkeypatch.setattr(app, "claim_next_job", lambda: None)
+    batch = client.post("/", data={"pdf_files": [report_file(42)]}, headers={"Accept": "application/json"}).json
+    response = client.get(f"/batches/{batch['batch_id']}/combined.pdf")
+    assert response.status_code == 409
+    assert response.json["jobs"][0]["status"] == "queued"
+
+
+def test_combined_pdf_of_unknown_batch_is_404(client):
+    assert client.get("/batches/nope/combined.pdf").status_code == 404
@@ -0,0 +1,65 @@
+import io
+
+import app
+from benchmark import make_synthetic_report
+
+
+def test_convert_streams_the_report_back(client):
+    response = client.post("/convert", data={"pdf_file": (io.BytesIO(make_synthetic_report(90)), "report.pdf")})
+    assert response.status_code == 200
+    assert response.mimetype == "application/pdf"
+    assert "report_extracted.pdf" in response.headers["Content-Disposition"]
+    assert response.data.startswith(b"%PDF")
+
+
+def test_convert_of_an_unreadable_pdf_is_422(client):
+    response = client.post("/convert", data={"pdf_file": (io.BytesIO(b"%PDF-1.4 garbage"), "report.pdf")})
+    assert response.status_code == 422
+    assert response.get_data(as_text=True).startswith("Could not convert report.pdf: ")
+
+
+def test_convert_runs_as_an_in_flight_job(client, monkeypatch):
+    run_conversion, running = app.run_conversion, []
+
+    def observed_conversion(source, output, engine=None, job_id=None, **options):
+        running.append(app.get_job(job_id))
+        return run_conversion(source, output, engine, job_id, **options)
+
+    monkeypatch.setattr(app, "run_conversion", observed_conversion)
+    response = client.post("/convert", data={"pdf_file": (io.BytesIO(make_synthetic_report(91)), "inflight.pdf")})
+    assert response.status_code == 200
+    # The conversion workers may be running jobs other tests queued meanwhile
+    (job,) = [job for job in running if job["filename"] == "inflight.pdf"]
+    assert (job["status"], job["pages"]) == ("running", 9)
+    assert app.get_job(job["id"])["status"] == "done"
+
+
+def test_convert_past_the_conversion_timeout_is_422(client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'CONVERSION_TIMEOUT', 0.01)
+    response = client.post("/convert", data={"pdf_file": (io.BytesIO(make_synthetic_report(92)), "report.pdf")})
+    assert response.status_code == 422
+    assert response.get_data(as_text=True) == "Could not convert report.pdf: Conversion timed out"
+
+
+def test_convert_writes_nothing_to_the_caches(client, monkeypatch, tmp_path):
+    # Converted in this process, to see its caches
+    monkeypatch.setitem(app.app.config, 'CONVERSION_EXECUTOR', "thread")
+    monkeypatch.setitem(app.app.config, 'IMAGE_CACHE_FOLDER', str(tmp_path))
+    monkeypatch.setattr(app, "image_cache", app.ContentCache("IMAGE_CACHE", ".img"))
+    response = client.post("/convert", data={"pdf_file": (io.BytesIO(make_synthetic_report(93)), "report.pdf")})
+    assert response.status_code == 200
+    assert len(app.image_cache._entries) == 3
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_web_only_worker_still_converts(client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'CONVERSION_WORKERS', 0)
+    monkeypatch.setattr(app, "_conversion_pool", None)
+    response = client.post("/convert", data={"pdf_file": (io.BytesIO(make_synthetic_report(94)), "report.pdf")})
+    app._conversion_pool.shutdown()
+    assert response.status_code == 200
+
+
+def test_convert_needs_a_pdf(client):
+    assert client.post("/convert").status_code == 400
+    assert client.post("/convert", data={"pdf_file": (io.BytesIO(b"text"), "notes.txt")}).status_code == 400
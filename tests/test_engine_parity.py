@@ -0,0 +1,26 @@
+import pytest
+
+import app
+from benchmark import make_synthetic_report
+
+
+def extract(source, engine):
+    with app.open_document(source, engine) as doc:
+        report = app.extract_report(doc)
+    # Metrics compare as their (name, value) rows
+    return {key: [tuple(row) for row in value] if isinstance(value, list) else value
+            for key, value in report.items()}
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_fitz_extracts_the_same_report_as_pdfplumber(seed):
+    source = make_synthetic_report(seed)
+    assert extract(source, "fitz") == extract(source, "pdfplumber")
+
+
+def test_fitz_report_has_every_metric():
+    report = extract(make_synthetic_report(3), "fitz")
+    assert set(report["images"]) == {"imagefrompage5", "imagefrompage6", "imagefrompage9"}
+    for key in app.METRIC_TABLE_KEYS:
+        assert report[key], key
+        assert not any(isinstance(value, app.Missing) for _, value in report[key]), key
@@ -0,0 +1,114 @@
+import io
+import time
+from contextlib import closing
+
+import pytest
+
+import app
+
+
+def test_batch_is_converted_in_the_background(client, report_file, finished_job):
+    files = [report_file(20), (io.BytesIO(b"not a pdf"), "bad.pdf"), report_file(21)]
+    response = client.post("/", data={"pdf_files": files}, headers={"Accept": "application/json"})
+    assert response.status_code == 202
+    jobs = [finished_job(job) for job in response.json["jobs"]]
+
+    assert [job["status"] for job in jobs] == ["done", "failed", "done"]
+    assert jobs[0]["metrics"]["Name"] == "Patient 20"
+    assert jobs[1]["error"]
+    result = client.get(jobs[2]["pdf_path"])
+    assert result.status_code == 200
+    assert result.mimetype == "application/pdf"
+    assert result.data.startswith(b"%PDF")
+
+
+def test_repeated_upload_is_served_from_the_result_cache(client, report_file, finished_job):
+    report, _ = report_file(22)
+    data = report.getvalue()
+    first = client.post("/", data={"pdf_files": [(report, "report.pdf")]}, headers={"Accept": "application/json"})
+    finished_job(first.json["jobs"][0])
+    again = client.post("/", data={"pdf_files": [(io.BytesIO(data), "copy.pdf")]},
+                        headers={"Accept": "application/json"})
+    assert again.json["jobs"][0]["status"] == "done"
+    assert again.json["jobs"][0]["metrics"]["Name"] == "Patient 22"
+
+
+def test_batch_page_lists_its_jobs(client, report_file):
+    response = client.post("/", data={"pdf_files": [report_file(23)]})
+    assert response.status_code == 202
+    assert "report23.pdf" in response.get_data(as_text=True)
+
+
+def test_unknown_job_is_404(client):
+    assert client.get("/jobs/nope").status_code == 404
+    assert client.get("/jobs/nope/result").status_code == 404
+
+
+def running_job(attempts=0, heartbeat_age=0, running_for=0):
+    """A job some worker claimed, with its heartbeat and start that many seconds ago."""
+    job_id = app.enqueue_job("stale", "report.pdf", "missing.pdf", "missing_extracted.pdf", "key", "pdfplumber")
+    now = time.time()
+    with closing(app.get_jobs_db()) as db:
+        db.execute(
+            "UPDATE jobs SET status = 'running', owner = 'gone:1', attempts = ?, heartbeat = ?, started_at = ?"
+            " WHERE id = ?",
+            (attempts, now - heartbeat_age, now - running_for, job_id),
+        )
+    return job_id
+
+
+@pytest.fixture
+def idle_workers(monkeypatch):
+    """Keep this process's conversion workers from claiming the jobs under test."""
+    monkeypatch.setattr(app, "claim_next_job", lambda: None)
+
+
+def test_job_abandoned_by_its_worker_is_requeued(idle_workers):
+    job_id = running_job(heartbeat_age=app.app.config['JOB_STALE_AFTER'] + 1)
+    assert app.recover_stale_jobs() == []
+    job = app.get_job(job_id)
+    assert (job["status"], job["attempts"], job["owner"]) == ("queued", 1, None)
+
+
+def test_job_abandoned_too_often_fails(idle_workers):
+    job_id = running_job(attempts=app.app.config['JOB_MAX_ATTEMPTS'] - 1,
+                         heartbeat_age=app.app.config['JOB_STALE_AFTER'] + 1)
+    assert app.recover_stale_jobs() == [job_id]
+    job = app.get_job(job_id)
+    assert (job["status"], job["error"]) == ("failed", "Conversion was interrupted")
+
+
+def test_abandoned_convert_is_failed_not_requeued(idle_workers):
+    job_id = app.enqueue_job("convert", "report.pdf", "", "", "", "pdfplumber", status="running")
+    with closing(app.get_jobs_db()) as db:
+        db.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?",
+                   (time.time() - app.app.config['JOB_STALE_AFTER'] - 1, job_id))
+    assert app.recover_stale_jobs() == [job_id]
+    assert app.get_job(job_id)["status"] == "failed"
+
+
+def test_job_running_past_its_timeout_fails(idle_workers):
+    config = app.app.config
+    job_id = running_job(running_for=config['CONVERSION_TIMEOUT'] + app.CONVERSION_TIMEOUT_GRACE
+                         + config['JOB_STALE_AFTER'] + 1)
+    assert app.recover_stale_jobs() == [job_id]
+    # The worker that finally finishes it does not overwrite the outcome
+    app.finish_job(job_id)
+    job = app.get_job(job_id)
+    assert (job["status"], job["error"]) == ("failed", "Conversion timed out")
+
+
+def test_live_job_is_left_running(idle_workers):
+    job_id = running_job(heartbeat_age=1, running_for=1)
+    app.recover_stale_jobs()
+    assert app.get_job(job_id)["status"] == "running"
+
+
+def test_old_finished_jobs_are_pruned(idle_workers):
+    job_id = running_job()
+    app.finish_job(job_id)
+    with closing(app.get_jobs_db()) as db:
+        db.execute("UPDATE jobs SET finished_at = ? WHERE id = ?",
+                   (time.time() - app.app.config['JOB_RETENTION'] - 1, job_id))
+    app.prune_jobs()
+    assert app.get_job(job_id) is None
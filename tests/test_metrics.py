@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def jobs_database(monkeypatch, tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    monkeypatch.setitem(app.app.config, 'JOBS_DATABASE', path)
+    return path
+
+
+def metric(client, series):
+    for line in client.get("/metrics").get_data(as_text=True).splitlines():
+        if line.startswith(series + " "):
+            return float(line.split(" ")[1])
+    return None
+
+
+def test_stage_timings_are_a_cumulative_histogram(client, jobs_database):
+    app.observe_stage_timings({"total": 0.2})
+    app.observe_stage_timings({"total": 3.0})
+    assert metric(client, 'pdfdata_stage_duration_seconds_bucket{stage="total",le="0.1"}') == 0
+    assert metric(client, 'pdfdata_stage_duration_seconds_bucket{stage="total",le="0.25"}') == 1
+    assert metric(client, 'pdfdata_stage_duration_seconds_bucket{stage="total",le="5.0"}') == 2
+    assert metric(client, 'pdfdata_stage_duration_seconds_bucket{stage="total",le="+Inf"}') == 2
+    assert metric(client, 'pdfdata_stage_duration_seconds_sum{stage="total"}') == pytest.approx(3.2)
+    assert app.retry_after(2 * app.WEB_CONCURRENCY * max(1, app.app.config['CONVERSION_WORKERS'])) == 4
+
+
+def test_metrics_add_up_every_worker_process(client, jobs_database):
+    app.count_conversion_error(app.ConversionTimeout())
+    # Another web worker, counting into the same queue database
+    script = "import app; app.count_conversion_error(ValueError()); app.observe_stage_timings({'parse': 0.01})"
+    subprocess.run([sys.executable, "-c", script], check=True, cwd=os.getcwd(), capture_output=True,
+                   env={**os.environ, "PYTHONPATH": app.app.root_path, "JOBS_DATABASE": jobs_database})
+    assert metric(client, 'pdfdata_conversion_errors_total{reason="timeout"}') == 1
+    assert metric(client, 'pdfdata_conversion_errors_total{reason="error"}') == 1
+    assert metric(client, 'pdfdata_stage_duration_seconds_count{stage="parse"}') == 1
@@ -0,0 +1,74 @@
+import sys
+import types
+
+import fitz
+import pytest
+
+import app
+from benchmark import make_synthetic_report
+
+
+def scanned(report):
+    """The report with every page replaced by a picture of it, as a scanner makes it: no text layer."""
+    with fitz.open(stream=report, filetype="pdf") as pdf, fitz.open() as scan:
+        for page in pdf:
+            scan.new_page(width=page.rect.width, height=page.rect.height).insert_image(
+                page.rect, pixmap=page.get_pixmap(dpi=50))
+        return scan.tobytes()
+
+
+@pytest.fixture
+def ocr_calls(monkeypatch, tmp_path):
+    """
+    Stands in for pytesseract, reading "Patient 7" on one line of every page; returns
+    the list of pages (rendered images) it was asked to read. OCR results go to an
+    empty cache of their own.
+    """
+    calls = []
+
+    def image_to_data(image, lang, output_type):
+        calls.append(image.size)
+        return {"text": ["Patient", " ", "7"], "left": [300, 0, 700], "top": [300, 0, 310],
+                "width": [350, 0, 50], "height": [60, 0, 50], "block_num": [1, 1, 1], "par_num": [1, 1, 1],
+                "line_num": [1, 1, 1]}
+
+    pytesseract = types.SimpleNamespace(image_to_data=image_to_data, Output=types.SimpleNamespace(DICT="dict"))
+    monkeypatch.setitem(sys.modules, "pytesseract", pytesseract)
+    monkeypatch.setattr(app, "PYTESSERACT_INSTALLED", True)
+    monkeypatch.setitem(app.app.config, 'OCR_ENABLED', True)
+    monkeypatch.setitem(app.app.config, 'OCR_CACHE_FOLDER', str(tmp_path))
+    monkeypatch.setattr(app, "ocr_cache", app.ContentCache("OCR_CACHE", ".json"))
+    return calls
+
+
+def read_words(source, engine, page_numbers=(1,), disk=True):
+    """The text and left edges of the words on each of the pages."""
+    with app.open_document(source, engine, disk) as doc:
+        return [(words.text.tolist(), [round(x0, 2) for x0 in words.x0.tolist()])
+                for words in map(doc.words, page_numbers)]
+
+
+def test_scanned_pages_are_read_once_with_ocr(ocr_calls):
+    source = scanned(make_synthetic_report(7))
+    dpi = app.app.config['OCR_DPI']
+    expected = (["Patient", "7"], [round(300 * 72 / dpi, 2), round(700 * 72 / dpi, 2)])
+    pages = app.TEMPLATE_TEXT_PAGES
+
+    assert read_words(source, "pdfplumber", pages) == [expected] * len(pages)
+    assert len(ocr_calls) == len(pages)
+    # Both engines read the same page content, so the other one is served from ocr_cache
+    assert read_words(source, "fitz", pages) == [expected] * len(pages)
+    assert len(ocr_calls) == len(pages)
+
+
+def test_ocr_without_disk_stays_in_memory(ocr_calls, tmp_path):
+    source = scanned(make_synthetic_report(8))
+    assert read_words(source, "fitz", disk=False)[0][0] == ["Patient", "7"]
+    assert ocr_calls
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_text_layer_is_not_read_with_ocr(ocr_calls):
+    [(words, _)] = read_words(make_synthetic_report(9), "fitz")
+    assert "9" in words
+    assert ocr_calls == []